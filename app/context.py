@@ -1,14 +1,64 @@
 from __future__ import annotations
 from collections import defaultdict
 from functools import cache
+import time
 import asyncio
 import redis
 from redis import asyncio as aioredis
+from prometheus_client import Counter, Gauge, Histogram
 import json
 import os
 import starlette.datastructures
 
 
+POOL_WAIT = Histogram(
+    'ptg_redis_pool_wait_seconds', 'Time spent waiting for a redis connection', ['pool'],
+    buckets=(.0005, .001, .005, .01, .05, .1, .25, .5, 1, 2.5))
+POOL_IN_USE = Gauge('ptg_redis_pool_in_use', 'Redis connections currently checked out', ['pool'])
+POOL_ERRORS = Counter('ptg_redis_pool_errors', 'Failures to get a redis connection (e.g. the pool is exhausted)', ['pool'])
+
+
+class PoolMetrics:
+    '''Record how long we wait for connections and how many are in use.'''
+    name = 'redis'
+
+    async def get_connection(self, *a, **kw):
+        t0 = time.monotonic()
+        try:
+            connection = await super().get_connection(*a, **kw)
+        except redis.exceptions.ConnectionError:
+            POOL_ERRORS.labels(self.name).inc()
+            raise
+        finally:
+            POOL_WAIT.labels(self.name).observe(time.monotonic() - t0)
+        self._checked_out.add(connection)
+        POOL_IN_USE.labels(self.name).inc()
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        # the pool also releases connections that it never handed out
+        if connection in self._checked_out:
+            self._checked_out.discard(connection)
+            POOL_IN_USE.labels(self.name).dec()
+
+    @classmethod
+    def create(cls, name, **kw):
+        pool = cls.from_url(**kw)
+        pool.name = name
+        pool._checked_out = set()
+        return pool
+
+
+class CommandPool(PoolMetrics, aioredis.ConnectionPool):
+    '''For short commands (GET/SET/XADD, pipelines, non-blocking reads).'''
+
+class BlockingReadPool(PoolMetrics, aioredis.BlockingConnectionPool):
+    '''For blocking stream reads (XREAD BLOCK). If all of the connections are
+    busy, readers wait up to ``timeout`` seconds and then fail instead of
+    taking connections away from the writers.'''
+
+
 def load_config(fname):
     with open(fname, 'r') as f:
         config = defaultdict(lambda: None, json.load(f))
@@ -48,11 +98,18 @@ class Context:
         if url:
             connection['url'] = url
 
+        # blocking reads get their own, separately sized pool
+        blocking = {
+            'max_connections': 512, 'timeout': 1,
+            **(self.config['redis'].get('blocking_connection') or {}),
+        }
         while True:
             try:
-                self.redis = await aioredis.from_url(**connection)
+                self.redis = aioredis.Redis(connection_pool=CommandPool.create('commands', **connection))
+                self.redis_blocking = aioredis.Redis(connection_pool=BlockingReadPool.create(
+                    'blocking', **{**connection, **blocking}))
                 self.redisClient = await aioredis.from_url(**connection, db=1)
-                await asyncio.gather(self.redis.ping(), self.redisClient.ping())
+                await asyncio.gather(self.redis.ping(), self.redis_blocking.ping(), self.redisClient.ping())
                 break
             except redis.exceptions.ConnectionError as e:
                 await asyncio.sleep(3)
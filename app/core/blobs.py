@@ -0,0 +1,163 @@
+'''Offload large payloads to local disk.
+
+Instead of keeping large entries in redis, their payload is appended to a
+segment file and only a small reference (``{segment}:{offset}:{length}``)
+is added to the stream, with the ``b`` field set. Readers resolve the
+references as zero-copy memoryviews of the memory-mapped segments.
+
+Each process writes to its own segment files (the names start with the
+creation time and the pid), so multiple workers never append to the same
+file. Segments are preallocated to ``segment_size`` and once a process has
+more than ``max_segments``, it deletes its oldest ones (along with any left
+by processes that have exited). Segments aren't tied to the streams'
+retention, so ``segment_size * max_segments`` should be enough to hold what
+the streams keep (e.g. their ``max_bytes``). Entries whose segment is already
+gone are dropped when they're read (and counted in
+``ptg_blob_missing_entries``).
+
+The recorder (and anything else reading redis directly) doesn't have access
+to the segments, so it gets the references instead of the payloads. Don't
+enable offloading for streams that need to be recorded.
+'''
+import os
+import glob
+import mmap
+import time
+from prometheus_client import Counter
+from app.context import Context
+
+ctx = Context.instance()
+
+MISSING_ENTRIES = Counter(
+    'ptg_blob_missing_entries', 'Entries dropped because their blob segment was deleted', ['sid'])
+
+BLOB_KEY = b'b'
+BLOB_PATH = os.getenv('BLOB_PATH') or ctx.config['blob_path'] or '/data/blobs'
+SEGMENT_EXT = '.seg'
+
+
+class BlobStore:
+    def __init__(self, path=BLOB_PATH, segment_size=None, max_segments=None):
+        self.path = path
+        self.segment_size = segment_size or ctx.config['blob_segment_size'] or 256 * 1024 * 1024
+        self.max_segments = max_segments or ctx.config['blob_max_segments'] or 16
+        self._maps = {}
+        self._fd = None
+        self._segment = None
+        self._segment_time = 0
+        self._offset = 0
+        self._size = 0
+
+    # writing
+
+    def write(self, data) -> bytes:
+        '''Append data to the current segment and return a reference to it.'''
+        if self._fd is None or self._offset + len(data) > self._size:
+            self._new_segment(len(data))
+        offset = self._offset
+        os.pwrite(self._fd, data, offset)
+        self._offset += len(data)
+        return f'{self._segment}:{offset}:{len(data)}'.encode('utf-8')
+
+    def _new_segment(self, min_size=0):
+        os.makedirs(self.path, exist_ok=True)
+        if self._fd is not None:
+            os.close(self._fd)
+        # unique even if segments fill up within the same millisecond
+        self._segment_time = max(int(time.time() * 1000), self._segment_time + 1)
+        self._segment = f'{self._segment_time}-{os.getpid()}'
+        self._size = max(self.segment_size, min_size)
+        self._offset = 0
+        self._fd = os.open(self._fname(self._segment), os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self._fd, self._size)  # sparse - so readers can map the whole segment at once
+        self._delete_old_segments()
+
+    def _delete_old_segments(self):
+        # other workers may still be writing to their segments, so only delete ours
+        fs = sorted(
+            (f for f in glob.glob(os.path.join(self.path, f'*{SEGMENT_EXT}')) if _is_owned(f)),
+            key=_segment_time)
+        for f in fs[:max(0, len(fs) - self.max_segments)]:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            # any existing views of the mapping stay valid until they're released
+            self._maps.pop(os.path.basename(f)[:-len(SEGMENT_EXT)], None)
+
+    # reading
+
+    def read(self, ref) -> memoryview:
+        '''Get the data for a reference returned by ``write``.'''
+        segment, offset, length = bytes(ref).decode('utf-8').rsplit(':', 2)
+        offset, length = int(offset), int(length)
+        mm = self._maps.get(segment)
+        if mm is None or offset + length > len(mm):
+            if mm is None:
+                self._drop_deleted_maps()
+            mm = self._maps[segment] = self._map(segment)
+        return memoryview(mm)[offset:offset + length]
+
+    def _drop_deleted_maps(self):
+        # forget segments deleted by other processes. Any existing views of
+        # the mapping stay valid until they're released.
+        for segment in list(self._maps):
+            if not os.path.exists(self._fname(segment)):
+                del self._maps[segment]
+
+    def _map(self, segment):
+        with open(self._fname(segment), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _fname(self, segment):
+        return os.path.join(self.path, f'{segment}{SEGMENT_EXT}')
+
+
+BLOBS = BlobStore()
+
+
+def _segment_time(fname):
+    try:
+        return int(os.path.basename(fname).split('-', 1)[0])
+    except ValueError:
+        return 0
+
+
+def _is_owned(fname):
+    # our segments, or those of a process that has exited
+    pid = os.path.basename(fname)[:-len(SEGMENT_EXT)].rpartition('-')[2]
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def resolve_entries(entries):
+    '''Replace any blob references with their data as returned by
+    XREAD/XRANGE: ``[(sid, [(entry_id, {b'd': ref, b'b': b'1'}), ...]), ...]``.
+    Entries whose segment was already deleted are dropped.'''
+    if not any(BLOB_KEY in d for _, data in entries for _, d in data):
+        return entries
+    resolved = []
+    for sid, data in entries:
+        kept = []
+        for ts, d in data:
+            if d.pop(BLOB_KEY, None):
+                try:
+                    d[b'd'] = BLOBS.read(d[b'd'])
+                except FileNotFoundError:
+                    MISSING_ENTRIES.labels(sid.decode('utf-8') if isinstance(sid, bytes) else sid).inc()
+                    continue
+            kept.append((ts, d))
+        if kept:
+            resolved.append((sid, kept))
+    return resolved
@@ -0,0 +1,113 @@
+'''Share a single stream reader between many consumers.
+
+Every pull websocket watching the same streams from "now" reads the exact
+same data, so instead of each connection running its own blocking ``XREAD``,
+we run one reader per distinct stream set / cursor mode and fan each batch
+out to all of the subscribed connections. ``BROADCASTS`` is shared by every
+router in the process.
+
+.. code-block:: python
+
+    with BROADCASTS.subscribe(['main', 'depthlt']) as sub:
+        while True:
+            entries = await sub.next()
+
+'''
+import asyncio
+import contextlib
+from app.core.streams import MultiStreamCursor
+
+
+class Subscription:
+    '''A bounded queue of batches for a single consumer.
+
+    If the consumer falls behind, the oldest batches are dropped so that it
+    skips ahead to the latest batch instead of stalling the shared reader.
+    '''
+    def __init__(self, maxsize=1, block=10000):
+        self.queue = asyncio.Queue(maxsize)
+        self.block = block
+        self.dropped = 0
+
+    def put(self, entries):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(entries)
+
+    async def next(self):
+        '''Get the next batch. Returns an empty list if nothing arrived
+        within ``block`` milliseconds (same as ``MultiStreamCursor.next``).'''
+        try:
+            entries = await asyncio.wait_for(self.queue.get(), self.block / 1000 if self.block else None)
+        except asyncio.TimeoutError:
+            return []
+        if isinstance(entries, Exception):
+            raise entries
+        return entries
+
+
+class StreamBroadcaster:
+    '''Runs a single cursor and pushes its batches to every subscriber.'''
+    def __init__(self, last, latest=True, time_sync_id=None, block=3000, decompress=True, count=1):
+        self.cursor = MultiStreamCursor(last, latest=latest, time_sync_id=time_sync_id, block=block, decompress=decompress)
+        self.count = count
+        self.subscribers = set()
+        self.task = None
+
+    def subscribe(self, maxsize=1, block=10000):
+        sub = Subscription(maxsize, block)
+        self.subscribers.add(sub)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return sub
+
+    def unsubscribe(self, sub):
+        self.subscribers.discard(sub)
+        if not self.subscribers:
+            self.close()
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        try:
+            while self.subscribers:
+                entries = await self.cursor.next(count=self.count)
+                if entries:
+                    for sub in list(self.subscribers):
+                        sub.put(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # let the consumers know that the reader died
+            for sub in list(self.subscribers):
+                sub.put(e)
+
+
+class StreamBroadcasts:
+    '''The process-wide collection of shared readers, keyed by the stream set
+    and cursor mode. Readers are created on the first subscription and shut
+    down when the last subscriber leaves.'''
+    def __init__(self):
+        self.broadcasters = {}
+
+    @contextlib.contextmanager
+    def subscribe(self, sids, latest=True, time_sync_id=None, maxsize=1, block=10000, decompress=True, count=1):
+        key = (tuple(sids), latest, time_sync_id, decompress, count)
+        bc = self.broadcasters.get(key)
+        if bc is None:
+            bc = self.broadcasters[key] = StreamBroadcaster(
+                dict.fromkeys(sids, '$'), latest=latest, time_sync_id=time_sync_id, decompress=decompress, count=count)
+        sub = bc.subscribe(maxsize, block)
+        try:
+            yield sub
+        finally:
+            bc.unsubscribe(sub)
+            if not bc.subscribers and self.broadcasters.get(key) is bc:
+                del self.broadcasters[key]
+
+
+BROADCASTS = StreamBroadcasts()
@@ -0,0 +1,68 @@
+'''Payload compression for stream entries.
+
+Compressed entries are stored with the codec name in the ``c`` field
+beside the data (``d``) field. If the requested codec isn't installed,
+we fall back to zlib.
+'''
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+CODEC_KEY = b'c'
+
+
+def available_codecs():
+    return [k for k, ok in (('zstd', zstandard), ('lz4', lz4), ('zlib', True)) if ok]
+
+
+def get_codec(name):
+    '''Get the codec that will actually be used for the requested codec.'''
+    if not name:
+        return None
+    name = name.lower()
+    if (name == 'zstd' and zstandard is None) or (name == 'lz4' and lz4 is None):
+        return 'zlib'
+    if name not in ('zstd', 'lz4', 'zlib'):
+        raise ValueError(f"Unknown compression codec: {name}. Use one of {available_codecs()}")
+    return name
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data, 1)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(data, codec):
+    codec = codec.decode('utf-8') if isinstance(codec, bytes) else codec
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4':
+        return lz4.frame.decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress_entries(entries):
+    '''Decompress the data of any compressed entries (in place) as returned by
+    XREAD/XRANGE: ``[(sid, [(entry_id, {b'd': data, b'c': codec}), ...]), ...]``.'''
+    for sid, data in entries:
+        for ts, d in data:
+            codec = d.pop(CODEC_KEY, None)
+            if codec:
+                d[b'd'] = decompress(d[b'd'], codec)
+    return entries
@@ -0,0 +1,262 @@
+'''Convert stream entries to other formats, sharing the results between clients.
+
+Converting an entry (e.g. decoding a holoframe and encoding it as a jpeg) is
+the same work for every client that asks for it, so converted payloads are
+kept in a process-wide LRU cache with a byte budget, keyed by
+``(sid, entry_id, output_format, options)``. If several clients miss on the
+same key at once, only the first one converts and the rest wait for its
+result.
+
+The conversions themselves run off of the event loop: conversions that
+only go through numpy/cv2 (which release the GIL) run in a thread pool and
+everything else (holoframe parsing, PIL encoding) runs in a process pool.
+Entries are submitted to the pool in one batch per stream, and large
+batches are handed to the worker processes through shared memory instead
+of being pickled.
+
+.. code-block:: python
+
+    entries = await convert_entries(entries, 'jpg')
+
+'''
+import asyncio
+import functools
+import collections
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from prometheus_client import Counter, Gauge
+from app.context import Context
+from app.core import converters
+
+ctx = Context.instance()
+
+CACHE_REQUESTS = Counter('ptg_conversion_cache_requests', 'Conversion cache lookups', ['result'])
+CACHE_EVICTIONS = Counter('ptg_conversion_cache_evictions', 'Converted entries evicted from the cache')
+CACHE_BYTES = Gauge('ptg_conversion_cache_bytes', 'Bytes held by the conversion cache')
+POOL_BATCHES = Counter('ptg_conversion_batches', 'Conversion batches submitted', ['executor'])
+
+# formats that are only handled by numpy/cv2, so they're fine to run in a thread
+THREAD_FORMATS = {'same', 'null', 'ndarray', 'accel', 'gyro', 'mag', 'json', 'nv12', 'pv'}
+# batches smaller than this are just pickled to the worker processes
+SHM_MIN_SIZE = 256 * 1024
+
+
+class ConversionCache:
+    '''An LRU cache of converted payloads, bounded by their total size.'''
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else (ctx.config['conversion_cache_size'] or 0)
+        self.items = collections.OrderedDict()
+        self.pending = {}
+        self.nbytes = 0
+
+    async def get_many(self, keys, convert, args):
+        '''Get the cached values for ``keys``. Any missing values are computed
+        together using ``await convert([args[i] for i in missing])``.'''
+        results = [None] * len(keys)
+        futs = {}
+        missing = []
+        loop = asyncio.get_running_loop()
+        for i, key in enumerate(keys):
+            if key in self.items:
+                self.items.move_to_end(key)
+                CACHE_REQUESTS.labels('hit').inc()
+                results[i] = self.items[key]
+            elif key in self.pending:  # someone is already converting it
+                CACHE_REQUESTS.labels('wait').inc()
+                futs[i] = self.pending[key]
+            else:
+                CACHE_REQUESTS.labels('miss').inc()
+                futs[i] = self.pending[key] = loop.create_future()
+                missing.append(i)
+
+        if missing:
+            # run it as its own task so that the other waiters still get
+            # their result if this caller is cancelled (e.g. disconnects)
+            task = asyncio.ensure_future(convert([args[i] for i in missing]))
+            task.add_done_callback(functools.partial(self._resolve, [keys[i] for i in missing]))
+        for i, fut in futs.items():
+            results[i] = await asyncio.shield(fut)
+        return results
+
+    def _resolve(self, keys, task):
+        error = None if task.cancelled() else task.exception()
+        for i, key in enumerate(keys):
+            fut = self.pending.pop(key)
+            if task.cancelled():
+                fut.cancel()
+            elif error is not None:
+                fut.set_exception(error)
+                fut.exception()  # mark as retrieved in case nobody was waiting
+            else:
+                value = task.result()[i]
+                self.put(key, value)
+                fut.set_result(value)
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        if key in self.items:
+            self.nbytes -= len(self.items.pop(key))
+        self.items[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.nbytes -= len(old)
+            CACHE_EVICTIONS.inc()
+        CACHE_BYTES.set(self.nbytes)
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+        CACHE_BYTES.set(0)
+
+
+CONVERSIONS = ConversionCache()
+
+
+class ConversionPool:
+    '''Runs conversions in a process pool, or a thread pool for the formats
+    that release the GIL. The pools are started on first use.'''
+    def __init__(self, processes=None, threads=None):
+        self.processes = processes if processes is not None else ctx.config['conversion_processes']
+        self.threads = threads if threads is not None else ctx.config['conversion_threads']
+        self._process_pool = None
+        self._thread_pool = None
+
+    @property
+    def process_pool(self):
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker)
+        return self._process_pool
+
+    @property
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                self.threads or None, thread_name_prefix='conversion')
+        return self._thread_pool
+
+    def uses_threads(self, output_format, input_format=None, sid=None):
+        if not self.processes:
+            return True
+        sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
+        input_format = converters._guess_input_format(sid, input_format)
+        return input_format.lower() in THREAD_FORMATS and output_format.lower() in THREAD_FORMATS
+
+    async def convert(self, payloads, output_format, input_format=None, sid=None, options=None):
+        '''Convert a batch of payloads from the same stream.'''
+        # look it up here first so that bad formats raise right away
+        converters.get_converter(output_format, input_format, sid, output_options=options)
+        loop = asyncio.get_running_loop()
+        args = (output_format, input_format, sid, options)
+        if self.uses_threads(output_format, input_format, sid):
+            POOL_BATCHES.labels('thread').inc()
+            return await loop.run_in_executor(self.thread_pool, _convert_batch, *args, payloads)
+
+        POOL_BATCHES.labels('process').inc()
+        try:
+            if sum(len(x) for x in payloads) < SHM_MIN_SIZE:
+                return await loop.run_in_executor(
+                    self.process_pool, _convert_batch, *args, [bytes(x) for x in payloads])
+            return await self._convert_shared(loop, args, payloads)
+        except BrokenProcessPool:
+            self._process_pool = None  # a worker died - start a new pool next time
+            raise
+
+    async def _convert_shared(self, loop, args, payloads):
+        spans = []
+        offset = 0
+        for x in payloads:
+            spans.append((offset, offset + len(x)))
+            offset += len(x)
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        try:
+            for (i, j), x in zip(spans, payloads):
+                shm.buf[i:j] = x
+            fut = loop.run_in_executor(self.process_pool, _convert_shared, *args, shm.name, spans)
+        except BaseException:
+            _release(shm)
+            raise
+        # the worker may still be reading after we're cancelled, so only
+        # release the block once it's done
+        fut.add_done_callback(lambda _: _release(shm))
+        return await fut
+
+    def shutdown(self):
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._process_pool = self._thread_pool = None
+
+
+POOL = ConversionPool()
+
+
+async def convert_entries(entries, output_format, input_format=None, options=None):
+    '''Convert the data of each entry as returned by XREAD/XRANGE:
+    ``[(sid, [(entry_id, {b'd': data}), ...]), ...]``.
+
+    ``options`` are the output converter options as a tuple of items
+    (see ``output_options``).'''
+    if not output_format:
+        return entries
+    converted = []
+    for sid, data in entries:
+        sid_str = sid.decode('utf-8') if isinstance(sid, bytes) else sid
+        keys = [(sid_str, ts, output_format, input_format, options) for ts, d in data]
+        convert = functools.partial(
+            POOL.convert, output_format=output_format, input_format=input_format,
+            sid=sid_str, options=options)
+        values = await CONVERSIONS.get_many(keys, convert, [d[b'd'] for ts, d in data])
+        converted.append([sid, [[ts, {**d, b'd': x}] for (ts, d), x in zip(data, values)]])
+    return converted
+
+
+def output_options(**options):
+    '''Get the (hashable) converter options, dropping the unset ones.'''
+    return tuple(sorted((k, v) for k, v in options.items() if v not in (None, False))) or None
+
+
+# worker functions
+
+def _init_worker():
+    import cv2
+    cv2.setNumThreads(1)  # the pool already gives us the parallelism
+
+
+def _convert_batch(output_format, input_format, sid, options, payloads):
+    cvt = converters.get_converter(output_format, input_format, sid, output_options=options)
+    return [_own(cvt(x)) for x in payloads]
+
+
+def _convert_shared(output_format, input_format, sid, options, name, spans):
+    cvt = converters.get_converter(output_format, input_format, sid, output_options=options)
+    shm = shared_memory.SharedMemory(name)
+    try:
+        buf = shm.buf
+        out = [_own(cvt(buf[i:j])) for i, j in spans]
+        del buf
+        return out
+    finally:
+        try:
+            shm.close()
+        except BufferError:  # something still has a view of it - let the gc clean it up
+            pass
+
+
+def _own(x):
+    # don't hand back views of a buffer that's about to be released
+    return bytes(x) if isinstance(x, memoryview) else x
+
+
+def _release(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
@@ -8,6 +8,7 @@ but maybe we'll just use the generic parser in holoframe instead.
 '''
 import io
 import functools
+from typing import ClassVar
 import orjson
 import numpy as np
 from PIL import Image as pil
@@ -45,17 +46,35 @@ hololens_sids = {
 def get_converter(output_format=None, input_format=None, sid=None, input_options=None, output_options=None):
     '''Convert from one format to another. If a stream id (sid) is provided,
     check if we have a data formatter matching the data type name from the sid.
+
+    The options are passed to the input/output converters and must be hashable,
+    e.g. ``output_options=(('max_width', 320), ('quality', 70))``.
     '''
     formatter = lambda x: x
     if output_format:
         sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
         input_format = _guess_input_format(sid, input_format)
-        load = registry[input_format.lower()](**(input_options or {})).load
-        dump = registry[output_format.lower()](**(output_options or {})).dump
+        loader = registry[input_format.lower()](**dict(input_options or ()))
+        dumper = registry[output_format.lower()](**dict(output_options or ()))
+        load, dump = loader.load, dumper.dump
         formatter = lambda x: dump(load(x))
+        # let the loader skip work if the output is going to be scaled down anyway
+        if loader.reduced_load and getattr(dumper, 'resizes', False):
+            formatter = functools.partial(_reduced_convert, loader, dumper)
     return formatter
 
 
+def _reduced_convert(loader, dumper, data):
+    # the loader may decode at a reduced size, so keep the output size
+    # relative to the original size
+    sizes = []
+    def target_size(w, h):
+        sizes.append(dumper.target_size(w, h))
+        return sizes[-1]
+    im = loader.load(data, target_size=target_size)
+    return dumper.dump(im, size=sizes[-1] if sizes else None)
+
+
 def _guess_input_format(sid, input_format=None):
     if input_format:
         return input_format
@@ -66,7 +85,8 @@ def _guess_input_format(sid, input_format=None):
 
 
 class Converter(DataModel):
-    pass
+    # whether load accepts a target_size function (see CompressedImage.target_size)
+    reduced_load: ClassVar[bool] = False
     # def load(self, data):
     #     raise NotImplementedError
     # def dump(self, data):
@@ -81,8 +101,9 @@ class Same(Converter):
 class Holo(Converter):
     key: str = None
     key_options = ['image', 'data', 'audio', 'lut', 'infrared']
-    def load(self, data):
-        return self._select_key(holoframe.load(data), self.key, self.key_options)
+    reduced_load: ClassVar[bool] = True
+    def load(self, data, target_size=None):
+        return self._select_key(holoframe.load(data, target_size=target_size), self.key, self.key_options)
 
     def _select_key(self, data, key, key_options):
         if key is False: return data
@@ -145,18 +166,90 @@ class Image(Converter):
 
 @registry.register
 class CompressedImage(Converter):
-    '''Convert images to and from bytes.'''
-    format: str = 'jpg'
-
-    def load(self, data: bytes) -> np.ndarray:
-        return np.array(pil.open(io.BytesIO(data)))
+    '''Convert images to and from bytes.
 
-    def dump(self, im: np.ndarray):
+    When dumping, the image can be scaled down (by ``scale`` and/or to fit
+    within ``max_width`` x ``max_height``, keeping the aspect ratio) and
+    converted to grayscale. ``quality`` is the jpeg quality (1-95).
+    '''
+    format: str = 'jpg'
+    quality: int = None
+    max_width: int = None
+    max_height: int = None
+    scale: float = None
+    grayscale: bool = False
+    reduced_load: ClassVar[bool] = True
+
+    @property
+    def resizes(self):
+        return bool(self.max_width or self.max_height or (self.scale and self.scale < 1))
+
+    def target_size(self, w, h):
+        '''Get the size that an image of size ``(w, h)`` will be dumped as,
+        or None if it won't be resized.'''
+        s = min(self.scale or 1, 1)
+        if self.max_width:
+            s = min(s, self.max_width / w)
+        if self.max_height:
+            s = min(s, self.max_height / h)
+        if s >= 1:
+            return None
+        return max(int(round(w * s)), 1), max(int(round(h * s)), 1)
+
+    def load(self, data: bytes, target_size=None) -> np.ndarray:
+        im = pil.open(io.BytesIO(data))
+        if target_size is not None:
+            size = target_size(*im.size)
+            if size:
+                im.draft(im.mode, size)  # reduced size jpeg decoding
+        return np.array(im)
+
+    def dump(self, im: np.ndarray, size=None):
+        if self.grayscale and im.ndim == 3:
+            im = cv2.cvtColor(im, cv2.COLOR_RGBA2GRAY if im.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+        if size is None and self.resizes:
+            size = self.target_size(im.shape[1], im.shape[0])
+        if size and size != (im.shape[1], im.shape[0]):
+            im = cv2.resize(im, size, interpolation=cv2.INTER_AREA)
         output = io.BytesIO()
-        pil.fromarray(im).save(output, format=self.format)
+        kw = {'quality': self.quality} if self.quality else {}
+        pil.fromarray(im).save(output, format=self.format, **kw)
         return output.getvalue()
 
 
+@registry.register
+class DepthViz(CompressedImage):
+    '''Colormap depth images (uint16, in mm) and compress them (e.g. as jpeg).
+
+    Depth is clipped to ``near`` - ``far`` and colored using ``colormap``
+    (an opencv colormap name) through a lookup table, so it's a single
+    ``take`` per frame. Pixels without a reading (0) are black.
+    '''
+    format: str = 'jpeg'
+    near: int = 0
+    far: int = 4000
+    colormap: str = 'turbo'
+
+    def dump(self, im: np.ndarray, size=None):
+        lut = depth_lut(self.near, self.far, self.colormap)
+        return super().dump(lut.take(np.asarray(im, dtype=np.uint16), axis=0), size=size)
+
+
+@functools.lru_cache(maxsize=16)
+def depth_lut(near=0, far=4000, colormap='turbo') -> np.ndarray:
+    '''Get a (65536, 3) table mapping uint16 depth values to RGB colors.'''
+    cmap = getattr(cv2, f'COLORMAP_{colormap.upper()}', None)
+    if cmap is None:
+        raise ValueError(f'Unknown colormap: {colormap}')
+    depth = np.arange(65536, dtype=np.float32)
+    levels = np.clip((depth - near) * (255 / max(far - near, 1)), 0, 255).astype(np.uint8)
+    colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, None], cmap)[:, 0, ::-1]  # BGR -> RGB
+    lut = colors[levels]
+    lut[0] = 0
+    lut.flags.writeable = False
+    return lut
+
+
 @registry.register
 class NV12(Image):
     '''Convert NV12 encoded images to and from bytes.'''
@@ -0,0 +1,77 @@
+'''Flow control for websocket ingest.
+
+A client is granted a number of credits, each allowing it to have one more
+batch in flight. Credits are returned as batches are written. The window
+follows AIMD: it shrinks by half when the write latency or the event loop
+lag is above target, and grows back slowly (up to the initial grant)
+otherwise.
+'''
+import time
+import asyncio
+
+
+class LoopLagMonitor:
+    '''Measure how late the event loop is at waking up from a sleep.'''
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lag = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return self
+
+    async def _run(self):
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0, time.monotonic() - t0 - self.interval)
+
+LOOP_LAG = LoopLagMonitor()
+
+
+class CreditWindow:
+    def __init__(self, credit, target_latency=0.1, target_lag=0.05):
+        self.max_size = max(1, credit)
+        self.size = float(self.max_size)
+        self.target_latency = target_latency
+        self.target_lag = target_lag
+        self.available = self.max_size  # credits the client can still use
+        self.outstanding = 0            # batches received but not written yet
+        self.closed = False
+        self._has_credit = asyncio.Event()
+        self._has_credit.set()
+        LOOP_LAG.start()
+
+    async def wait(self):
+        '''Wait until the client is allowed to send another batch. Raises if
+        the window was closed (i.e. no more credits will be returned).'''
+        await self._has_credit.wait()
+        if self.closed:
+            raise ConnectionAbortedError('No more credits will be granted')
+
+    def close(self):
+        '''Stop granting credits, waking up anyone waiting for one.'''
+        self.closed = True
+        self._has_credit.set()
+
+    def take(self):
+        '''A batch was received.'''
+        self.available -= 1
+        self.outstanding += 1
+        if self.available <= 0:
+            self._has_credit.clear()
+
+    def complete(self, latency) -> int:
+        '''A batch was written. Returns the number of credits to grant.'''
+        self.outstanding -= 1
+        if latency > self.target_latency or LOOP_LAG.lag > self.target_lag:
+            self.size = max(1., self.size / 2)
+        else:
+            self.size = min(float(self.max_size), self.size + 1 / self.size)
+        credit = max(0, int(self.size) - self.outstanding - self.available)
+        self.available += credit
+        if self.available > 0:
+            self._has_credit.set()
+        return credit
@@ -2,6 +2,7 @@
 
 '''
 from __future__ import annotations
+import io
 import struct
 from collections import defaultdict
 import orjson
@@ -85,6 +86,10 @@ header_dtype = np.dtype([
     ('ftype', np.uint8),
     ('time', np.uint64),
 ])
+# frame types that don't start with header_dtype
+# json dict/list, hand+eye (json), microphone
+NO_HEADER_FRAME_TYPES = [123, 93, SensorType.Hand, SensorType.Mic]
+
 header2_dtype = np.dtype([
     ('w', np.uint32),
     ('h', np.uint32),
@@ -93,9 +98,50 @@ header2_dtype = np.dtype([
 ])
 
 
-def load(data, metadata=False, only_header=False):
-    '''Parse any frame of data coming from the hololens.'''
-    parse = ByteParser(data)
+def load_times(frames):
+    '''Get the device timestamp for a batch of frames by only reading their
+    headers (no image decoding). This is equivalent to
+    ``[load(d).get('time') for d in frames]``.
+
+    Frames without a timestamp in their header (json, hand/eye, mic) return None.
+    '''
+    headers = np.zeros(len(frames), dtype=header_dtype)
+    valid = np.zeros(len(frames), dtype=bool)
+    for i, data in enumerate(frames):
+        if len(data) >= header_dtype.itemsize:
+            headers[i] = np.frombuffer(data, header_dtype, 1)[0]
+            valid[i] = True
+    valid &= ~np.isin(headers['ftype'], NO_HEADER_FRAME_TYPES)
+    return [t if v else None for t, v in zip(headers['time'].tolist(), valid.tolist())]
+
+
+JPEG_SOI = b'\xff\xd8'
+
+def get_jpeg(data):
+    '''Get the jpeg image embedded in a frame without decoding it, or None if
+    the frame doesn't have one that can be used as is. Only v2 PV frames
+    qualify - the grayscale cameras need to be rotated and v3 PV frames are
+    loaded without swapping their channels (see ``load_v3``), so sending the
+    jpeg as is would show different colors than converting it.'''
+    start = header_dtype.itemsize + header2_dtype.itemsize
+    if len(data) < start:
+        return None
+    version, ftype, _ = np.frombuffer(data, header_dtype, 1)[0]
+    if version != 2 or ftype != SensorType.PV:
+        return None
+    _, _, size, _ = np.frombuffer(data, header2_dtype, 1, header_dtype.itemsize)[0]
+    jpeg = memoryview(data)[start:start + int(size)]
+    return jpeg if bytes(jpeg[:2]) == JPEG_SOI else None
+
+
+def load(data, metadata=False, only_header=False, target_size=None):
+    '''Parse any frame of data coming from the hololens.
+
+    ``target_size`` is a function ``(w, h) -> (w, h) | None`` giving the size
+    the images will be scaled down to. If given, jpeg images are decoded at
+    a reduced size (1/2, 1/4, 1/8) when that's still at least that big.
+    '''
+    parse = ByteParser(data, target_size)
     read = not metadata  # disable reading images
 
     version, ftype, ts = parse.pop(header_dtype)
@@ -284,10 +330,24 @@ def load_v3(parse, read, ftype, d):
 
 
 
+JPEG_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# single channel jpegs (e.g. the grayscale cameras) stay single channel
+JPEG_REDUCED_GRAYSCALE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
 class ByteParser:
-    def __init__(self, data):
+    def __init__(self, data, target_size=None):
         self.data = memoryview(data)
         self.offset = 0
+        self.target_size = target_size
 
     @property
     def remaining(self) -> int:
@@ -323,13 +383,28 @@ class ByteParser:
         return im
     
     def _read_jpeg_image(self, buffer: memoryview, rot=0, bgr2rgb=False) -> np.ndarray:
-        im = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        flags = cv2.IMREAD_UNCHANGED
+        if self.target_size is not None:
+            factor, mode = self._jpeg_reduction(buffer, rot)
+            reduced = JPEG_REDUCED_GRAYSCALE_FLAGS if mode == 'L' else JPEG_REDUCED_FLAGS
+            flags = reduced.get(factor, flags)
+        im = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), flags)
         if bgr2rgb:
             im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
         if rot:
             im = np.rot90(im, rot)
         return im
 
+    def _jpeg_reduction(self, buffer: memoryview, rot=0) -> tuple[int, str]:
+        # only reads the jpeg header
+        im = Image.open(io.BytesIO(buffer))
+        w, h = im.size
+        size = self.target_size(*((h, w) if rot % 2 else (w, h)))
+        if not size:
+            return 1, im.mode
+        tw, th = (size[1], size[0]) if rot % 2 else size
+        return next((f for f in (8, 4, 2) if w // f >= tw and h // f >= th), 1), im.mode
+
     def _read_json(self, x: memoryview):
         return orjson.loads(str(x, 'ascii'))
 
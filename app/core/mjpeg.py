@@ -0,0 +1,316 @@
+'''Produce MJPEG frames once per stream and share them between viewers.
+
+Each stream being watched has a single ``MjpegProducer`` that follows the
+latest entries (through the shared stream reader) and turns them into
+multipart frames. If the entry already contains a jpeg (v2 PV frames, or
+``input=jpg``) and no output options were asked for, the jpeg is sent as is.
+Otherwise the entry is converted (see ``convert_entries``). The producer
+stops when its last viewer leaves.
+
+Each viewer only holds the newest frame. Frames that arrive while the
+previous one is still being sent (e.g. a viewer on a slow link) replace
+it, so latency doesn't build up. The viewer can also ask for a lower frame
+rate.
+
+.. code-block:: python
+
+    with MJPEG.subscribe('main', fps=10) as viewer:
+        async for frame in viewer.frames():
+            await send(frame)
+
+Several streams can also be watched as a single mosaic. A ``MosaicProducer``
+keeps the newest frame of each stream, draws the ones that changed into a
+preallocated canvas (scaled to fit their tile), and encodes the canvas once
+per tick for every viewer of that layout.
+
+.. code-block:: python
+
+    with MJPEG.subscribe_mosaic(['main', 'gll', 'glf', 'depthlt'], 'grid') as viewer:
+        ...
+
+'''
+import math
+import asyncio
+import contextlib
+import cv2
+import numpy as np
+from prometheus_client import Counter, Histogram
+from app.context import Context
+from app.core import holoframe, converters
+from app.core.broadcast import BROADCASTS, Subscription
+from app.core.conversions import POOL, convert_entries
+from app.core.pacing import PACING
+
+ctx = Context.instance()
+
+FRAMES = Counter('ptg_mjpeg_frames', 'MJPEG frames produced', ['sid', 'mode'])
+SENT = Counter('ptg_mjpeg_sent_frames', 'MJPEG frames sent to a viewer', ['viewer'])
+DROPPED = Counter('ptg_mjpeg_dropped_frames', 'MJPEG frames skipped for a viewer', ['viewer'])
+SEND_SECONDS = Histogram(
+    'ptg_mjpeg_send_seconds', 'Time to send an MJPEG frame to a viewer',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+BOUNDARY = 'frame'
+LAYOUTS = ('grid', 'row', 'column')
+
+
+def to_frame(jpeg, content_type='image/jpeg'):
+    '''Format a jpeg as a part of a multipart/x-mixed-replace response.'''
+    return b''.join([
+        f'--{BOUNDARY}\r\nContent-Type: {content_type}\r\n\r\n'.encode('utf-8'),
+        jpeg, b'\r\n',
+    ])
+
+
+def get_jpeg(data, input_format=None):
+    '''Get the jpeg from an entry if it can be sent without re-encoding.'''
+    if input_format and input_format.lower() in ('jpg', 'jpeg'):
+        return data
+    if input_format and input_format.lower() != 'holo':
+        return None
+    return holoframe.get_jpeg(data)
+
+
+class MjpegViewer(Subscription):
+    '''Holds the newest frame for a viewer.'''
+    def __init__(self, name=None, fps=None):
+        super().__init__(maxsize=1, block=None)
+        self.name = name or str(id(self))
+        self.interval = 1 / fps if fps else 0
+
+    def put(self, frame):
+        if self.queue.full():
+            DROPPED.labels(self.name).inc()
+        super().put(frame)
+
+    async def frames(self):
+        '''Yield the newest frame each time the previous one has been sent
+        (resumed), at most ``fps`` times per second.'''
+        loop = asyncio.get_running_loop()
+        next_time = 0
+        try:
+            while True:
+                if loop.time() < next_time:
+                    await PACING.sleep_until(next_time)
+                frame = await self.next()
+                t0 = next_time = loop.time()
+                next_time += self.interval
+                yield frame
+                SEND_SECONDS.observe(loop.time() - t0)
+                SENT.labels(self.name).inc()
+        finally:
+            for metric in (SENT, DROPPED):
+                try:
+                    metric.remove(self.name)
+                except KeyError:
+                    pass
+
+
+class MjpegProducer:
+    '''Reads the latest frames of a stream and encodes them once for all viewers.
+
+    Viewers get ``None`` if there were no new frames within ``block`` milliseconds.
+    '''
+    def __init__(self, sid, input_format=None, options=None, output_format='jpg', block=3000):
+        self.sid = sid
+        self.input_format = input_format
+        self.options = options
+        self.output_format = output_format
+        self.block = block
+        self.viewers = set()
+        self.task = None
+
+    def subscribe(self, name=None, fps=None):
+        viewer = MjpegViewer(name, fps)
+        self.viewers.add(viewer)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return viewer
+
+    def unsubscribe(self, viewer):
+        self.viewers.discard(viewer)
+        if not self.viewers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        try:
+            with BROADCASTS.subscribe([self.sid], block=self.block) as sub:
+                while self.viewers:
+                    entries = await sub.next()
+                    frame = await self.encode(entries) if entries else None
+                    for viewer in list(self.viewers):
+                        viewer.put(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for viewer in list(self.viewers):
+                viewer.put(e)
+
+    async def encode(self, entries):
+        '''Get the multipart frame for the newest entry in a batch.'''
+        sid, data = entries[-1]
+        ts, d = data[-1]
+        jpeg = None if self.options or self.output_format != 'jpg' else get_jpeg(d[b'd'], self.input_format)
+        if jpeg is not None:
+            FRAMES.labels(self.sid, 'passthrough').inc()
+        else:
+            converted = await convert_entries([(sid, [(ts, d)])], self.output_format, self.input_format, self.options)
+            jpeg = converted[0][1][0][1][b'd']
+            FRAMES.labels(self.sid, 'encoded').inc()
+        return to_frame(jpeg)
+
+
+def layout_shape(n, layout='grid'):
+    '''Get the (rows, columns) to tile ``n`` images in.'''
+    if layout == 'row':
+        return 1, n
+    if layout == 'column':
+        return n, 1
+    cols = math.ceil(math.sqrt(n))
+    return math.ceil(n / cols), cols
+
+
+class Mosaic:
+    '''A preallocated RGB canvas that images are tiled into.'''
+    def __init__(self, n, layout='grid', tile_size=(320, 240), depth_lut=None):
+        self.rows, self.cols = layout_shape(n, layout)
+        self.depth_lut = depth_lut if depth_lut is not None else converters.depth_lut()
+        self.tile_width, self.tile_height = tile_size
+        self.canvas = np.zeros((self.rows * self.tile_height, self.cols * self.tile_width, 3), dtype=np.uint8)
+
+    def target_size(self, w, h):
+        '''Get the size to fit a ``(w, h)`` image into a tile, or None if it already fits.'''
+        s = min(self.tile_width / w, self.tile_height / h)
+        if s >= 1:
+            return None
+        return max(int(w * s), 1), max(int(h * s), 1)
+
+    def draw(self, i, im):
+        '''Scale an image to fit tile ``i`` (keeping its aspect ratio) and center it there.'''
+        r, c = divmod(i, self.cols)
+        tile = self.canvas[
+            r * self.tile_height:(r + 1) * self.tile_height,
+            c * self.tile_width:(c + 1) * self.tile_width]
+        tile[:] = 0
+        if im is None or not im.size:
+            return
+        im = _as_rgb8(im, self.depth_lut)
+        h, w = im.shape[:2]
+        s = min(self.tile_width / w, self.tile_height / h)
+        size = min(max(int(w * s), 1), self.tile_width), min(max(int(h * s), 1), self.tile_height)
+        if size != (w, h):
+            im = cv2.resize(im, size, interpolation=cv2.INTER_AREA if s < 1 else cv2.INTER_LINEAR)
+        x = (self.tile_width - size[0]) // 2
+        y = (self.tile_height - size[1]) // 2
+        tile[y:y + size[1], x:x + size[0]] = im
+
+
+def _as_rgb8(im, depth_lut):
+    if im.dtype == np.uint16:  # depth
+        return depth_lut.take(im, axis=0)
+    if im.dtype != np.uint8:
+        im = cv2.convertScaleAbs(im, alpha=255 / max(float(im.max()), 1))
+    if im.ndim == 2 or im.shape[2] == 1:
+        return cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
+    return im[..., :3]
+
+
+class MosaicProducer(MjpegProducer):
+    '''Tiles the latest frames of several streams into one image, encoded
+    once every ``1 / fps`` seconds for all viewers (if anything changed).'''
+    def __init__(self, sids, layout='grid', input_format=None, options=None, fps=None, tile_size=(320, 240), block=3000):
+        super().__init__('+'.join(sids), input_format, options, block=block)
+        self.sids = list(sids)
+        self.interval = 1 / (fps or ctx.config['mosaic_fps'] or 10)
+        self.dumper = converters.registry['jpg'](**dict(options or ()))
+        depth = {k: v for k, v in (options or ()) if k in ('near', 'far', 'colormap')}
+        self.mosaic = Mosaic(len(self.sids), layout, tile_size, converters.depth_lut(**depth))
+        self.latest = {}  # the newest frames that haven't been drawn yet
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            with BROADCASTS.subscribe(self.sids, block=self.block) as sub:
+                reader = asyncio.create_task(self._read(sub))
+                try:
+                    next_time = loop.time()
+                    while self.viewers:
+                        next_time = max(next_time + self.interval, loop.time())
+                        await PACING.sleep_until(next_time)
+                        if reader.done():
+                            reader.result()  # raise the reader's error
+                        frame = await self.render()
+                        if frame is not None:
+                            for viewer in list(self.viewers):
+                                viewer.put(frame)
+                finally:
+                    reader.cancel()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for viewer in list(self.viewers):
+                viewer.put(e)
+
+    async def _read(self, sub):
+        while True:
+            for sid, data in await sub.next():
+                sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
+                self.latest[sid] = data[-1][1][b'd']
+
+    async def render(self):
+        '''Draw the streams with new frames and encode the mosaic, or return
+        None if nothing changed since the last tick.'''
+        if not self.latest:
+            return None
+        latest, self.latest = self.latest, {}
+        loop = asyncio.get_running_loop()
+        ims = await asyncio.gather(*(
+            loop.run_in_executor(POOL.thread_pool, self._load, sid, data)
+            for sid, data in latest.items()))
+        jpeg = await loop.run_in_executor(POOL.thread_pool, self._draw, list(zip(latest, ims)))
+        FRAMES.labels(self.sid, 'mosaic').inc()
+        return to_frame(jpeg)
+
+    def _load(self, sid, data):
+        input_format = converters._guess_input_format(sid, self.input_format)
+        loader = converters.registry[input_format.lower()]()
+        if loader.reduced_load:  # decode jpegs at a reduced size if they're going to be scaled down
+            return loader.load(data, target_size=self.mosaic.target_size)
+        return loader.load(data)
+
+    def _draw(self, images):
+        for sid, im in images:
+            self.mosaic.draw(self.sids.index(sid), im)
+        return self.dumper.dump(self.mosaic.canvas)
+
+
+class MjpegProducers:
+    '''The process-wide producers, keyed by stream and output format.'''
+    def __init__(self):
+        self.producers = {}
+
+    def subscribe(self, sid, input_format=None, options=None, output_format='jpg', name=None, fps=None):
+        key = (sid, input_format, options, output_format)
+        return self._subscribe(key, lambda: MjpegProducer(sid, input_format, options, output_format), name, fps)
+
+    def subscribe_mosaic(self, sids, layout='grid', input_format=None, options=None, tile_size=(320, 240), name=None, fps=None):
+        sids = list(dict.fromkeys(sids))  # one tile per stream
+        key = ('mosaic', tuple(sids), layout, input_format, options, tuple(tile_size))
+        return self._subscribe(key, lambda: MosaicProducer(sids, layout, input_format, options, tile_size=tile_size), name, fps)
+
+    @contextlib.contextmanager
+    def _subscribe(self, key, create, name=None, fps=None):
+        producer = self.producers.get(key)
+        if producer is None:
+            producer = self.producers[key] = create()
+        viewer = producer.subscribe(name, fps)
+        try:
+            yield viewer
+        finally:
+            producer.unsubscribe(viewer)
+            if not producer.viewers and self.producers.get(key) is producer:
+                del self.producers[key]
+
+
+MJPEG = MjpegProducers()
@@ -0,0 +1,131 @@
+'''Deliver batches to a connection at a fixed rate without blocking the event loop.
+
+All paced connections share a single timer task (``PACING``). Each
+connection has a ``Pacer`` that reads batches from its source in the
+background and hands them out at most once every ``interval`` seconds.
+With ``latest=True``, batches that arrive while waiting replace the pending
+one (and are counted as skipped) instead of queueing up.
+
+.. code-block:: python
+
+    pacer = Pacer(0.5, latest=True, name='client-1')
+    async for entries in pacer.pace(batches):
+        await send(entries)
+
+'''
+import heapq
+import asyncio
+import itertools
+from prometheus_client import Counter
+
+DELIVERED = Counter('ptg_paced_batches_delivered', 'Batches delivered to rate limited connections', ['client'])
+SKIPPED = Counter('ptg_paced_batches_skipped', 'Stale batches skipped for rate limited connections', ['client'])
+
+
+class PacingScheduler:
+    '''A single timer task that wakes up every paced connection when it's due.'''
+    def __init__(self):
+        self.heap = []
+        self.changed = None
+        self.task = None
+        self._count = itertools.count()
+
+    def sleep_until(self, t) -> asyncio.Future:
+        '''Return a future that is resolved at loop time ``t``.'''
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        heapq.heappush(self.heap, (t, next(self._count), fut))
+        if self.task is None or self.task.done():
+            self.changed = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        if self.heap[0][2] is fut:  # new earliest deadline
+            self.changed.set()
+        return fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.heap:
+            t, _, fut = self.heap[0]
+            delay = t - loop.time()
+            if delay > 0:
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            if not fut.done():
+                fut.set_result(None)
+
+PACING = PacingScheduler()
+
+
+class Pacer:
+    _END = object()
+
+    def __init__(self, interval, latest=True, name=None, scheduler=PACING):
+        self.interval = interval
+        self.latest = latest
+        self.name = name or str(id(self))
+        self.scheduler = scheduler
+        self.queue = asyncio.Queue(1)
+        self.next_time = 0
+        self.error = None
+        self.delivered = 0
+        self.skipped = 0
+
+    async def put(self, entries):
+        if self.latest and self.queue.full():
+            self.queue.get_nowait()
+            self.skipped += 1
+            SKIPPED.labels(self.name).inc()
+        await self.queue.put(entries)
+
+    async def get(self):
+        entries = await self.queue.get()
+        loop = asyncio.get_running_loop()
+        if entries is not self._END and loop.time() < self.next_time:
+            await self.scheduler.sleep_until(self.next_time)
+            # something newer may have come in while we were waiting
+            if self.latest and not self.queue.empty():
+                newer = self.queue.get_nowait()
+                if newer is self._END:
+                    self.queue.put_nowait(newer)
+                else:
+                    entries = newer
+                    self.skipped += 1
+                    SKIPPED.labels(self.name).inc()
+        self.next_time = loop.time() + self.interval
+        return entries
+
+    async def pace(self, batches):
+        '''Re-yield the batches from an async iterator at the paced rate.'''
+        feeder = asyncio.create_task(self._feed(batches))
+        try:
+            while True:
+                entries = await self.get()
+                if entries is self._END:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.delivered += 1
+                DELIVERED.labels(self.name).inc()
+                yield entries
+        finally:
+            feeder.cancel()
+            for metric in (DELIVERED, SKIPPED):
+                try:
+                    metric.remove(self.name)
+                except KeyError:
+                    pass
+
+    async def _feed(self, batches):
+        try:
+            async for entries in batches:
+                await self.put(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        await self.queue.put(self._END)
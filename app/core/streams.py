@@ -1,13 +1,24 @@
 import time
+import heapq
 import asyncio
+import itertools
 import orjson
+import redis
+import numpy as np
 from collections import defaultdict
-from typing import Awaitable
+from typing import Awaitable, NamedTuple
+from prometheus_client import Counter
 from app.context import Context
 from app.core.utils import redis_id_to_iso,  parse_epoch_time, format_epoch_ts
+from app.core import compression, blobs, holoframe
 
 ctx = Context.instance()
 
+DROPPED_ENTRIES = Counter(
+    'ptg_stream_dropped_entries', 'Entries dropped at ingest by stream decimation', ['sid'])
+UNMATCHED_ENTRIES = Counter(
+    'ptg_aligned_unmatched_entries', 'Entries dropped by aligned cursors without a match', ['sid'])
+
 
 def _postprocess_stream_info(info, meta, sid):
     d = {'sid': sid}
@@ -25,9 +36,149 @@ def _postprocess_stream_info(info, meta, sid):
     d['meta'] = str(meta) if isinstance(info, Exception) else meta
     return d
 
+# ptg_xadd: add an entry to each stream and apply each stream's retention policy, in one call.
+#   KEYS: the stream IDs
+#   ARGV: for each stream: entry ID, data, compression codec ('' = none),
+#         blob reference flag ('' = none), payload size, max_len, max_age (ms), max_bytes (0 = no limit)
+# max_bytes is applied as a max_len estimated from the payload size of the new entry
+# (for blob references, the size of the offloaded payload, not the reference).
+# Returns the ID of each new entry. An entry that can't be added (e.g. an explicit ID
+# that isn't after the last one) gets its error message prefixed with '!' instead, and
+# the other entries are still added.
+STREAMS_LIBRARY = '''#!lua name=ptg
+local function xadd_trim(keys, args)
+  local t = redis.call('TIME')
+  local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+  local ids = {}
+  for i, key in ipairs(keys) do
+    local j = (i - 1) * 8
+    local data = args[j + 2]
+    local codec = args[j + 3]
+    local blob = args[j + 4]
+    local size = tonumber(args[j + 5])
+    local max_len = tonumber(args[j + 6])
+    local max_age = tonumber(args[j + 7])
+    local max_bytes = tonumber(args[j + 8])
+    if max_bytes > 0 then
+      local n = math.max(1, math.floor(max_bytes / math.max(1, size)))
+      if max_len <= 0 or n < max_len then max_len = n end
+    end
+    local cmd = {'XADD', key}
+    if max_len > 0 then
+      -- approximate trimming only works in whole nodes (100 entries by default)
+      table.insert(cmd, 'MAXLEN')
+      table.insert(cmd, max_len >= 1000 and '~' or '=')
+      table.insert(cmd, max_len)
+    end
+    table.insert(cmd, args[j + 1])
+    table.insert(cmd, 'd')
+    table.insert(cmd, data)
+    if codec ~= '' then
+      table.insert(cmd, 'c')
+      table.insert(cmd, codec)
+    end
+    if blob ~= '' then
+      table.insert(cmd, 'b')
+      table.insert(cmd, blob)
+    end
+    local id = redis.pcall(unpack(cmd))
+    if type(id) == 'table' and id.err then
+      ids[i] = '!' .. tostring(id.err)
+    else
+      ids[i] = id
+      if max_age > 0 then
+        redis.call('XTRIM', key, 'MINID', '=', now - max_age)
+      end
+    end
+  end
+  return ids
+end
+redis.register_function('ptg_xadd', xadd_trim)
+
+-- ptg_last_ids: the latest entry IDs of each stream, without their data.
+--   KEYS: the stream IDs
+--   ARGV: count
+local function last_ids(keys, args)
+  local count = tonumber(args[1])
+  local ids = {}
+  for i, key in ipairs(keys) do
+    local s = {}
+    for j, entry in ipairs(redis.call('XREVRANGE', key, '+', '-', 'COUNT', count)) do
+      s[j] = entry[1]
+    end
+    ids[i] = s
+  end
+  return ids
+end
+redis.register_function{function_name='ptg_last_ids', callback=last_ids, flags={'no-writes'}}
+
+-- ptg_decimate: check (and update) the decimation state of each new entry, so that
+-- the policy applies to the stream as a whole rather than to each worker.
+--   KEYS: the decimation state key of each entry's stream (one per entry, in order)
+--   ARGV: for each entry: keep_every, min_interval (us)
+local function decimate(keys, args)
+  local t = redis.call('TIME')
+  local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+  local keep = {}
+  for i, key in ipairs(keys) do
+    local keep_every = tonumber(args[i * 2 - 1])
+    local min_interval = tonumber(args[i * 2])
+    local ok = 1
+    if keep_every > 1 then
+      local n = redis.call('HINCRBY', key, 'n', 1) - 1
+      if n % keep_every ~= 0 then ok = 0 end
+    end
+    if ok == 1 and min_interval > 0 then
+      local last = tonumber(redis.call('HGET', key, 't') or 0)
+      if now - last < min_interval then
+        ok = 0
+      else
+        redis.call('HSET', key, 't', now)
+      end
+    end
+    keep[i] = ok
+  end
+  return keep
+end
+redis.register_function('ptg_decimate', decimate)
+'''
+
+
+class EntryWriteError(Exception):
+    '''Some of the entries couldn't be added. ``ids`` has the ID of each
+    entry (None if it was dropped or failed) and ``errors`` the error of
+    each entry (None if it didn't fail).'''
+    def __init__(self, ids, errors):
+        super().__init__('; '.join(dict.fromkeys(e for e in errors if e)))
+        self.ids = ids
+        self.errors = errors
+
+
+class StreamPolicy(NamedTuple):
+    '''Per-stream ingest settings, read from the stream metadata.'''
+    max_len: int = 0         # retention: maximum number of entries
+    max_age: int = 0         # retention: maximum entry age (ms)
+    max_bytes: int = 0       # retention: approximate maximum stream size
+    keep_every: int = 0      # decimation: only keep every Nth entry
+    max_rate: float = 0      # decimation: keep at most this many entries per second
+    compression: str = None  # the codec used to compress entries (see app.core.compression)
+    blob_min_size: int = 0   # offload payloads larger than this to disk (see app.core.blobs)
+
+    @property
+    def retention(self):
+        return self.max_len, self.max_age, self.max_bytes
+
+
 class Streams:
     META_PREFIX = 'XMETA'
+    DECIMATE_PREFIX = 'XDECIMATE'
     MAXLEN = ctx.config['default_max_len']
+    POLICY_TTL = 5  # seconds to cache the policies read from the stream metadata
+    LAST_IDS_TTL = 0.05  # seconds to share the latest entry IDs between requests
+    _policies = {}
+    _last_ids = {}
+    _library_loaded = False
+
     async def list_streams(self):
         return sorted([x.decode('utf-8') async for x in ctx.redis.scan_iter(_type='stream')])
 
@@ -51,11 +202,14 @@ class Streams:
         return await ctx.redis.get(f'{self.META_PREFIX}:{sid}')
 
     async def set_stream_meta(self, sid: str, *, _update=False, **meta):
+        '''Set the stream metadata. Raises ValueError if any of the policy keys are invalid.'''
+        check_policy(meta)
         key = f'{self.META_PREFIX}:{sid}'
         if _update:
             previous = await ctx.redis.get(key)
             if previous:
                 meta = dict(orjson.loads(previous), **meta)
+        self._policies.pop(sid, None)
         return await ctx.redis.set(key, orjson.dumps(meta))
 
     async def trim_stream(self, sid, maxlen=None, minid=None, **kw):
@@ -64,24 +218,129 @@ class Streams:
     async def delete_stream(self, sid):
         async with ctx.redis.pipeline() as pipe:
             for sid in sid.split('+'):
+                self._policies.pop(sid, None)
                 pipe.delete(f'{self.META_PREFIX}:{sid}')
+                pipe.delete(f'{self.DECIMATE_PREFIX}:{sid}')
                 pipe.xtrim(sid, 0, approximate=False)
                 pipe.delete(sid)
             return await pipe.execute()
 
-    @staticmethod
-    async def add_entries(entries: list, include_static_key=False):
-        maxlen = ctx.config['default_max_len']
-        async with ctx.redis.pipeline() as pipe:
-            for sid, ts, data in entries:
-                pipe.xadd(sid, {b'd': data}, ts or '*', maxlen=maxlen, approximate=True)
-                if include_static_key:
+    @classmethod
+    async def add_entries(cls, entries: list, include_static_key=False):
+        '''Add entries to their streams. Entries dropped by the stream's
+        decimation policy get None instead of an entry ID. If any entries
+        fail, the rest are still added and ``EntryWriteError`` is raised.'''
+        entries = [(maybe_utf_decode(sid), ts, data) for sid, ts, data in entries]
+        policies = await cls.get_policies([sid for sid, _, _ in entries])
+        keep = await cls._decimate(entries, policies)
+        kept = [e for e, k in zip(entries, keep) if k]
+        if not kept:
+            return [None] * len(entries)
+
+        ids = iter(await cls._fcall('ptg_xadd', [sid for sid, _, _ in kept], [
+            x for sid, ts, data in kept
+            for x in cls._encode_entry(ts, data, policies[sid])
+        ]))
+        if include_static_key:
+            async with ctx.redis.pipeline() as pipe:
+                for sid, ts, data in kept:
                     pipe.set(sid, data)
-            res = await pipe.execute()
-        return res
+                await pipe.execute()
+        results = [next(ids) if k else None for k in keep]
+        errors = [x[1:].decode('utf-8') if x and x[:1] == b'!' else None for x in results]
+        if any(errors):
+            raise EntryWriteError([None if e else x for x, e in zip(results, errors)], errors)
+        return results
+
+    @staticmethod
+    def _encode_entry(ts, data, policy):
+        '''Get the ptg_xadd arguments for an entry.'''
+        if policy.compression:
+            data = compression.compress(data, policy.compression)
+        size = len(data)
+        blob = bool(policy.blob_min_size and size >= policy.blob_min_size)
+        if blob:
+            data = blobs.BLOBS.write(data)
+        return (ts or '*', data, policy.compression or '', '1' if blob else '', size, *policy.retention)
+
+    @classmethod
+    async def get_policies(cls, sids):
+        '''Get the ingest policy for each stream. These are set using the
+        ``max_len``, ``max_age`` (seconds), ``max_bytes``, ``keep_every``,
+        ``max_rate``, ``compression``, and ``blob_min_size`` keys of the stream
+        metadata. ``max_len`` and ``blob_min_size`` default to ``default_max_len``
+        and ``blob_min_size`` from the config.'''
+        now = time.time()
+        missing = list({
+            sid for sid in sids
+            if now - cls._policies.get(sid, (0, None))[0] > cls.POLICY_TTL
+        })
+        if missing:
+            metas = await ctx.redis.mget([f'{cls.META_PREFIX}:{sid}' for sid in missing])
+            for sid, meta in zip(missing, metas):
+                cls._policies[sid] = (now, _parse_policy(meta, sid))
+        return {sid: cls._policies[sid][1] for sid in sids}
+
+    @classmethod
+    async def get_last_ids(cls, sids, count=1, max_age=None):
+        '''Get the latest ``count`` entry IDs of each stream (newest first),
+        without reading their data. Results are shared between callers for
+        ``LAST_IDS_TTL`` seconds (or ``max_age``).'''
+        key = (tuple(sids), count)
+        now = time.time()
+        t, ids = cls._last_ids.get(key, (0, None))
+        if ids is None or now - t > (cls.LAST_IDS_TTL if max_age is None else max_age):
+            ids = await cls._fcall('ptg_last_ids', list(sids), [count])
+            ids = [[maybe_utf_decode(x) for x in xs] for xs in ids]
+            cls._last_ids[key] = (now, ids)
+            # don't let the cache grow with every stream combination ever requested
+            for k in [k for k, (t, _) in cls._last_ids.items() if now - t > 60]:
+                del cls._last_ids[k]
+        return dict(zip(sids, ids))
+
+    @classmethod
+    async def _decimate(cls, entries, policies):
+        '''Check which entries to keep according to their stream's decimation
+        policy. The state is kept in redis so that ``keep_every`` and ``max_rate``
+        apply to the stream as a whole, no matter which worker gets the entries.'''
+        keep = [True] * len(entries)
+        decimated = [
+            i for i, (sid, _, _) in enumerate(entries)
+            if policies[sid].keep_every > 1 or policies[sid].max_rate > 0
+        ]
+        if not decimated:
+            return keep
+        args = []
+        for i in decimated:
+            policy = policies[entries[i][0]]
+            args += [policy.keep_every, int(1e6 / policy.max_rate) if policy.max_rate > 0 else 0]
+        results = await cls._fcall('ptg_decimate', [f'{cls.DECIMATE_PREFIX}:{entries[i][0]}' for i in decimated], args)
+        for i, k in zip(decimated, results):
+            if not k:
+                keep[i] = False
+                DROPPED_ENTRIES.labels(entries[i][0]).inc()
+        return keep
+
+    @classmethod
+    async def _fcall(cls, name, keys, args):
+        if not cls._library_loaded:
+            await cls._load_library()
+        try:
+            return await ctx.redis.execute_command('FCALL', name, len(keys), *keys, *args)
+        except redis.exceptions.ResponseError as e:
+            # e.g. if redis was restarted without persistence
+            if 'function not found' not in str(e).lower():
+                raise
+            await cls._load_library()
+            return await ctx.redis.execute_command('FCALL', name, len(keys), *keys, *args)
+
+    @classmethod
+    async def _load_library(cls):
+        await ctx.redis.execute_command('FUNCTION', 'LOAD', 'REPLACE', STREAMS_LIBRARY)
+        cls._library_loaded = True
 
     @staticmethod
-    async def get_entries(streams, count: int, block: int = None):
+    async def get_entries(streams, count: int, block: int = None, decompress: bool = True):
         star = [k for k, v in streams.items() if v == '*']
         nonstar = {k: v for k, v in streams.items() if v != '*'}
 
@@ -92,17 +351,238 @@ class Streams:
                     pipe.xrevrange(sid, count=count)
                 calls[0] = pipe.execute()
             if nonstar:
-                calls[1] = ctx.redis.xread(nonstar, count=count, block=block)
+                r = ctx.redis if block is None else ctx.redis_blocking
+                calls[1] = r.xread(nonstar, count=count, block=block)
             res_star, res_nonstar = await asyncio.gather(*(x or noop() for x in calls))
             #print('block', block, [[s, len(t)] for s,t in res_nonstar])
 
         entries = [(sid, sorted(d)) for sid, d in zip(star, res_star)] + res_nonstar
+        entries = blobs.resolve_entries(entries)
+        if decompress:
+            entries = compression.decompress_entries(entries)
         return entries
 
+    @staticmethod
+    async def iter_range(sids, start='-', end='+', page_size=256, decompress=True):
+        '''Walk XRANGE over multiple streams, yielding batches merged in entry ID
+        order. At most ``page_size`` entries per stream are held at a time, so
+        memory use doesn't depend on the size of the window. ``start`` can
+        also be a dict with the start of each stream.'''
+        starts = {sid: start[sid] for sid in sids} if isinstance(start, dict) else dict.fromkeys(sids, start)
+        buffers = {sid: [] for sid in sids}
+        done = set()
+        while True:
+            need = [sid for sid in sids if not buffers[sid] and sid not in done]
+            if need:
+                async with ctx.redis.pipeline() as pipe:
+                    for sid in need:
+                        pipe.xrange(sid, starts[sid], end, count=page_size)
+                    results = await pipe.execute()
+                for sid, data in zip(need, results):
+                    if len(data) < page_size:
+                        done.add(sid)
+                    if data:
+                        starts[sid] = b'(' + data[-1][0]  # exclusive
+                        buffers[sid] = data
+            if not any(buffers.values()):
+                return
+
+            # only entries up to the last buffered ID of the unfinished streams
+            # are safe to emit - the next page of those streams could come before anything after
+            bound = min((_id_key(buffers[sid][-1][0]) for sid in sids if sid not in done), default=None)
+            ready = {}
+            for sid in sids:
+                data = buffers[sid]
+                i = len(data) if bound is None else next(
+                    (i for i, (ts, d) in enumerate(data) if _id_key(ts) > bound), len(data))
+                ready[sid], buffers[sid] = data[:i], data[i:]
+
+            merged = heapq.merge(*(
+                [(_id_key(ts), sid, (ts, d)) for ts, d in data]
+                for sid, data in ready.items()
+            ), key=lambda x: x[0])
+            entries = [
+                (sid, [x[2] for x in group])
+                for sid, group in itertools.groupby(merged, key=lambda x: x[1])
+            ]
+            entries = blobs.resolve_entries(entries)
+            if decompress:
+                entries = compression.decompress_entries(entries)
+            yield entries
+
+
+def _id_key(entry_id):
+    ms, _, seq = (entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id).partition('-')
+    return int(ms), int(seq or 0)
+
 async def noop():
     return []
 
 
+# the numeric policy keys in the stream metadata and their types
+POLICY_NUMBERS = {
+    'max_len': int,
+    'max_age': float,
+    'max_bytes': int,
+    'keep_every': int,
+    'max_rate': float,
+    'blob_min_size': int,
+}
+
+
+def check_policy(meta):
+    '''Check the policy keys of stream metadata (see ``Streams.get_policies``).
+    Raises ValueError if any of them are invalid.'''
+    for key, cast in POLICY_NUMBERS.items():
+        _policy_number(meta, key, cast)
+    _policy_codec(meta)
+
+
+def _policy_codec(meta):
+    codec = meta.get('compression')
+    if codec is not None and not isinstance(codec, str):
+        raise ValueError(f"Invalid compression: {codec!r} (expected a codec name)")
+    return compression.get_codec(codec)
+
+
+def _policy_number(meta, key, cast, default=0):
+    value = meta.get(key)
+    if value is None or value == '':
+        return default
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        x = cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {key}: {value!r} (expected a number)") from None
+    if x < 0:
+        raise ValueError(f"Invalid {key}: {value!r} (must not be negative)")
+    return x
+
+
+def _parse_policy(meta, sid=None):
+    try:
+        meta = orjson.loads(meta) if meta else {}
+    except orjson.JSONDecodeError:
+        meta = {}
+    if not isinstance(meta, dict):
+        meta = {}
+    defaults = {
+        'max_len': ctx.config['default_max_len'] or 0,
+        'blob_min_size': ctx.config['blob_min_size'] or 0,
+    }
+    # bad values (e.g. stored before they were checked) fall back to
+    # the defaults so that the stream can still be written to
+    values = {}
+    for key, cast in POLICY_NUMBERS.items():
+        try:
+            values[key] = _policy_number(meta, key, cast, defaults.get(key, 0))
+        except ValueError as e:
+            print(f"stream {sid}: {e} - using the default", flush=True)
+            values[key] = defaults.get(key, 0)
+    try:
+        codec = _policy_codec(meta)
+    except ValueError as e:
+        print(f"stream {sid}: {e} - not compressing", flush=True)
+        codec = None
+    return StreamPolicy(
+        max_len=int(values['max_len']),
+        max_age=int(values['max_age'] * 1000),
+        max_bytes=int(values['max_bytes']),
+        keep_every=int(values['keep_every']),
+        max_rate=float(values['max_rate']),
+        compression=codec,
+        blob_min_size=int(values['blob_min_size']),
+    )
+
+
+class EntryWriter:
+    '''Coalesce entries from consecutive batches into a single pipeline.
+
+    ``add`` queues a batch and returns a future with the batch's entry IDs.
+    A background task gathers queued batches until ``max_entries`` or
+    ``max_bytes`` is reached or ``max_delay`` seconds have passed since the
+    first one, and writes them all with one ``add_entries`` call. Batches are
+    written in the order they were added.
+    '''
+    def __init__(self, max_entries=256, max_bytes=16*1024*1024, max_delay=0.002):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def add(self, entries) -> asyncio.Future:
+        entries = list(entries)
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((entries, fut))
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return fut
+
+    async def close(self):
+        '''Finish writing anything that has been queued and stop.'''
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closed = False
+        while not closed:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batches = [item]
+            n, nbytes = self._size(item)
+            deadline = loop.time() + self.max_delay
+            while n < self.max_entries and nbytes < self.max_bytes:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    closed = True
+                    break
+                batches.append(item)
+                k, size = self._size(item)
+                n, nbytes = n + k, nbytes + size
+            await self._write(batches)
+
+    def _size(self, item):
+        entries, _ = item
+        return len(entries), sum(len(d) for _, _, d in entries)
+
+    async def _write(self, batches):
+        errors = None
+        try:
+            res = await Streams.add_entries([e for entries, _ in batches for e in entries])
+        except EntryWriteError as e:
+            # only fail the batches with entries that failed
+            res, errors = e.ids, e.errors
+        except Exception as e:
+            for _, fut in batches:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        i = 0
+        for entries, fut in batches:
+            if not fut.done():
+                batch_errors = errors and errors[i:i+len(entries)]
+                if batch_errors and any(batch_errors):
+                    fut.set_exception(EntryWriteError(res[i:i+len(entries)], batch_errors))
+                else:
+                    fut.set_result(res[i:i+len(entries)])
+            i += len(entries)
+
+
 
 def maybe_utf_encode(txt):
     return txt.encode('utf-8') if isinstance(txt, str) else txt
@@ -111,8 +591,17 @@ def maybe_utf_decode(txt):
     return txt.decode('utf-8') if isinstance(txt, bytes) else txt
 
 class MultiStreamCursor:
-    def __init__(self, last, latest=True, block=10000, time_sync_id=None, replace_dollar=True, redis=None):
+    '''Read from multiple streams at once.
+
+    By default, each stream is read independently (or all of them follow
+    ``time_sync_id``'s last ID). With ``align='id'`` or ``align='time'``,
+    the entries are paired up instead (see ``StreamAligner``) so that the
+    i-th entry of each stream in a batch belong together.
+    '''
+    def __init__(self, last, latest=True, block=10000, time_sync_id=None, replace_dollar=True, redis=None, decompress=True,
+                 align=None, align_tolerance=50, align_window=1000):
         self.r = ctx.redis if redis is None else redis
+        self.r_blocking = ctx.redis_blocking if redis is None else redis
         tnow = format_epoch_ts(time.time())
         self.last = {
             maybe_utf_encode(sid): tnow if replace_dollar and t == '$' else t
@@ -121,8 +610,17 @@ class MultiStreamCursor:
         self.latest = latest
         self.block = block
         self.time_sync_id = maybe_utf_encode(time_sync_id)
+        self.decompress = decompress
+        self.aligner = None
+        if align:
+            self.aligner = StreamAligner(
+                list(self.last), self.time_sync_id, by=align, tolerance=align_tolerance, window=align_window)
+            # we need the frame headers to get the device time
+            self.decompress = decompress or align == 'time'
 
     async def next(self, **kw):
+        if self.aligner is not None:
+            return await self.next_aligned(**kw)
         # query next value
         result = await (self.next_latest(**kw) if self.latest else self.next_consecutive(**kw))
         # update to the latest timestamp
@@ -132,6 +630,9 @@ class MultiStreamCursor:
             main_ts = self.last[self.time_sync_id]
             for sid in self.last:
                 self.last[sid] = main_ts
+        result = blobs.resolve_entries(result)
+        if self.decompress:
+            result = compression.decompress_entries(result)
         return result
 
     async def next_latest(self, **kw):
@@ -185,5 +686,145 @@ class MultiStreamCursor:
         are
         '''
         # block using last timestamp
-        return await self.r.xread(self.last, block=self.block, count=count)
+        r = self.r if self.block is None else self.r_blocking
+        return await r.xread(self.last, block=self.block, count=count)
+
+    async def next_aligned(self, count=None):
+        '''Read every entry and return the ones that could be paired up.
+        Blocks until there's at least one match or the read times out.'''
+        while True:
+            result = await self.next_consecutive(count=max(count or 1, 32))
+            if not result:
+                return self.aligner.pop()
+            for sid, ts in result:
+                self.last[sid] = ts[-1][0]
+            result = blobs.resolve_entries(result)
+            if self.decompress:
+                result = compression.decompress_entries(result)
+            self.aligner.add(result)
+            matched = self.aligner.pop()
+            if matched:
+                return matched
+
+
+class StreamAligner:
+    '''Pair up entries from multiple streams by their nearest timestamps.
+
+    Entries are buffered per stream and each entry of the reference stream
+    is matched with the nearest entry of every other stream (using
+    ``np.searchsorted`` over the buffered times). A reference entry is
+    only matched once every other stream has data past its time plus the
+    tolerance (so nothing closer can still arrive), or once it's older
+    than ``window`` compared to the newest buffered entry.
+
+    Reference entries without a match within ``tolerance`` are dropped, as
+    are entries of the other streams that never got used.
+
+    Arguments:
+        sids: the streams to align.
+        ref: the stream to align the others to. Defaults to the first one.
+        by: ``'id'`` to use the redis entry IDs or ``'time'`` to use the
+            hololens device time (from the frame header).
+        tolerance: the maximum time difference of a match (milliseconds).
+        window: how long to wait for a match (milliseconds).
+    '''
+    TIME_SCALES = {'id': 1, 'time': 10_000}  # ms -> device time units (100ns)
+
+    def __init__(self, sids, ref=None, by='id', tolerance=50, window=1000):
+        if by not in self.TIME_SCALES:
+            raise ValueError(f"Unknown alignment {by!r}. Use one of {set(self.TIME_SCALES)}")
+        self.sids = [maybe_utf_encode(s) for s in sids]
+        self.ref = maybe_utf_encode(ref) or self.sids[0]
+        self.by = by
+        self.tolerance = tolerance * self.TIME_SCALES[by]
+        self.window = window * self.TIME_SCALES[by]
+        self.times = {sid: np.zeros(0) for sid in self.sids}
+        self.entries = {sid: [] for sid in self.sids}
+        self.used = {sid: set() for sid in self.sids}
+        self.dropped = defaultdict(int)
+        self.floor = -np.inf
+
+    def add(self, entries):
+        for sid, data in entries:
+            sid = maybe_utf_encode(sid)
+            if sid not in self.entries:
+                continue
+            ts = self._get_times(data)
+            valid = ~np.isnan(ts)
+            if not valid.all():  # e.g. frames without a header
+                self._drop(sid, int((~valid).sum()))
+            self.times[sid] = np.concatenate([self.times[sid], ts[valid]])
+            self.entries[sid].extend(x for x, v in zip(data, valid) if v)
+
+    def _get_times(self, data):
+        if self.by == 'time':
+            ts = holoframe.load_times([d[b'd'] for _, d in data])
+        else:
+            ts = [_id_key(t) for t, _ in data]
+            ts = [ms + seq * 1e-6 for ms, seq in ts]
+        return np.array([np.nan if t is None else t for t in ts], dtype=float)
+
+    def pop(self):
+        '''Get the matched entries as ``[(sid, [entry, ...]), ...]`` where
+        the i-th entries of each stream form a match.'''
+        ref_t = self.times[self.ref]
+        others = [sid for sid in self.sids if sid != self.ref]
+        newest = max((t[-1] for t in self.times.values() if len(t)), default=None)
+        if newest is None:
+            return []
+
+        # how many reference entries can be decided
+        settled = min((self.times[sid][-1] if len(self.times[sid]) else -np.inf for sid in others), default=np.inf)
+        cutoff = max(settled - self.tolerance, newest - self.window)
+        n = int(np.searchsorted(ref_t, cutoff, side='right'))
+
+        t = ref_t[:n]
+        matched = np.ones(n, dtype=bool)
+        nearest = {}
+        for sid in others:
+            ot = self.times[sid]
+            if not len(ot):
+                matched[:] = False
+                nearest[sid] = np.zeros(n, dtype=int)
+                continue
+            j = np.searchsorted(ot, t).clip(1, max(len(ot) - 1, 1))
+            left = j - 1
+            right = np.minimum(j, len(ot) - 1)
+            idx = np.where(np.abs(t - ot[left]) <= np.abs(ot[right] - t), left, right)
+            matched &= np.abs(ot[idx] - t) <= self.tolerance
+            nearest[sid] = idx
+
+        keep = np.flatnonzero(matched)
+        result = []
+        if len(keep):
+            result.append((self.ref, [self.entries[self.ref][i] for i in keep]))
+            for sid in others:
+                idx = nearest[sid][keep]
+                self.used[sid].update(idx.tolist())
+                result.append((sid, [self.entries[sid][i] for i in idx]))
+        if n:
+            self._drop(self.ref, n - len(keep))
+            self.floor = ref_t[n - 1]
+        self._trim(self.ref, n)
+
+        # drop anything from the other streams that's too old for the remaining reference entries
+        lo = self.times[self.ref][0] if len(self.times[self.ref]) else max(self.floor, newest - self.window)
+        for sid in others:
+            self._trim(sid, int(np.searchsorted(self.times[sid], lo - self.tolerance, side='left')))
+        return result
+
+    def _trim(self, sid, n):
+        if not n:
+            return
+        unused = n - sum(1 for i in self.used[sid] if i < n)
+        if sid != self.ref:
+            self._drop(sid, unused)
+        self.times[sid] = self.times[sid][n:]
+        self.entries[sid] = self.entries[sid][n:]
+        self.used[sid] = {i - n for i in self.used[sid] if i >= n}
+
+    def _drop(self, sid, n):
+        if n > 0:
+            self.dropped[sid] += n
+            UNMATCHED_ENTRIES.labels(maybe_utf_decode(sid)).inc(n)
 
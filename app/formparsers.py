@@ -0,0 +1,76 @@
+'''Incremental multipart/form-data parsing.
+
+Starlette parses the whole form before calling the endpoint, which means
+that a large upload is held in memory (or spooled) before we can do
+anything with it. This yields each part as soon as it has been received.
+'''
+import typing as t
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+
+class FormPart(t.NamedTuple):
+    name: str
+    filename: t.Optional[str]
+    data: bytearray
+
+
+async def iter_multipart(request: Request) -> t.AsyncIterator[FormPart]:
+    '''Parse a multipart/form-data request body, one part at a time.
+    Malformed requests raise a 400.'''
+    content_type = request.headers.get('Content-Type')
+    if not content_type:
+        raise HTTPException(400, "Missing Content-Type. Expected multipart/form-data.")
+    _, params = parse_options_header(content_type)
+    if b'boundary' not in params:
+        raise HTTPException(400, "Missing boundary in multipart.")
+
+    parts = []
+    header = {'field': b'', 'value': b''}
+    current = {}
+
+    def on_part_begin():
+        current.clear()
+        current['data'] = bytearray()
+
+    def on_part_data(data, start, end):
+        current['data'] += data[start:end]
+
+    def on_part_end():
+        _, options = parse_options_header(current.get(b'content-disposition', b''))
+        filename = options.get(b'filename')
+        parts.append(FormPart(
+            options.get(b'name', b'').decode('utf-8'),
+            filename.decode('utf-8') if filename is not None else None,
+            current['data']))
+
+    def on_header_field(data, start, end):
+        header['field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header['value'] += data[start:end]
+
+    def on_header_end():
+        current[header['field'].lower()] = header['value']
+        header['field'] = header['value'] = b''
+
+    parser = MultipartParser(params[b'boundary'], {
+        'on_part_begin': on_part_begin,
+        'on_part_data': on_part_data,
+        'on_part_end': on_part_end,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            while parts:
+                yield parts.pop(0)
+        parser.finalize()
+    except MultipartParseError as e:
+        raise HTTPException(400, f"Invalid multipart body: {e}")
+    while parts:
+        yield parts.pop(0)
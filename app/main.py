@@ -7,11 +7,12 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 from app.context import Context
 from app.core.recordings import RECORDING_POST_PATH, RECORDING_RAW_PATH
+from app.core import conversions
 from app.static import AuthStaticFiles
-from app.routers import data, misc, streams, recipes, session, sessions, recording, mjpeg
+from app.routers import data, misc, streams, recipes, session, sessions, recording, mjpeg, events
 
 ctx = Context.instance()
-routers = [misc, streams, data, recipes, session, sessions, recording, mjpeg]
+routers = [misc, streams, data, recipes, session, sessions, recording, mjpeg, events]
 tags = [t for r in routers for t in r.tags]
 
 app = FastAPI(title=ctx.config['title'],
@@ -55,6 +56,11 @@ async def startup():
     await ctx.initialize()
 
 
+@app.on_event('shutdown')
+async def shutdown():
+    conversions.POOL.shutdown()
+
+
 @app.exception_handler(Exception)
 async def validation_exception_handler(request, err):
     return JSONResponse(status_code=500, content={
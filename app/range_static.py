@@ -1,11 +1,13 @@
 import os
 import re
 import stat
+import secrets
 import typing as t
 from urllib.parse import quote
 
 import aiofiles
 from aiofiles.os import stat as aio_stat
+from starlette.concurrency import run_in_threadpool
 from starlette.datastructures import Headers
 from starlette.exceptions import HTTPException
 from starlette.responses import Response, guess_type
@@ -13,7 +15,11 @@ from starlette.staticfiles import StaticFiles
 from starlette.types import Receive, Scope, Send
 
 
-RANGE_REGEX = re.compile(r"^bytes=(?P<start>\d+)-(?P<end>\d*)$")
+RANGE_REGEX = re.compile(r"^\s*(?P<start>\d*)\s*-\s*(?P<end>\d*)\s*$")
+# the most ranges we'll answer in one (multipart/byteranges) response
+MAX_RANGES = 32
+# the ASGI extension for servers that can send files with sendfile
+ZEROCOPY = "http.response.zerocopysend"
 
 
 PathLike = t.Union[str, "os.PathLike[str]"]
@@ -25,7 +31,7 @@ class OpenRange(t.NamedTuple):
 
     def clamp(self, start: int, end: int) -> "ClosedRange":
         begin = max(self.start, start)
-        end = min((x for x in (self.end, end) if x))
+        end = min((x for x in (self.end, end) if x is not None))
         return ClosedRange(min(begin, end), max(begin, end))
 
 
@@ -40,13 +46,57 @@ class ClosedRange(t.NamedTuple):
         return len(self) > 0
 
 
+def parse_range_header(value: str, size: int, max_length: t.Optional[int] = None) -> t.List[ClosedRange]:
+    '''Parse a ``Range: bytes=...`` header for a file of ``size`` bytes.
+
+    Handles multiple ranges and suffix ranges (``bytes=-500``). Open ended
+    ranges are limited to ``max_length`` bytes if given. Raises a 400 if
+    the header is malformed and a 416 if none of the ranges are satisfiable.
+    '''
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        raise HTTPException(400)
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        raise HTTPException(400, f"Too many ranges (max {MAX_RANGES})")
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_REGEX.match(spec)
+        if not match or not (match.group("start") or match.group("end")):
+            raise HTTPException(400)
+        start, end = match.group("start"), match.group("end")
+        if not start:  # the last n bytes
+            start, end = size - int(end), size - 1
+        else:
+            start = int(start)
+            end = int(end) if end else (start + max_length - 1 if max_length else size - 1)
+        start = max(start, 0)
+        if start >= size or end < start:
+            continue  # unsatisfiable
+        ranges.append(ClosedRange(start, min(end, size - 1)))
+    if not ranges:
+        raise HTTPException(416, headers={"content-range": f"bytes */{size}"})
+    return ranges
+
+
 class RangedFileResponse(Response):
-    chunk_size = 4096
+    '''Send parts of a file.
+
+    A single range is sent as a 206 with a ``content-range`` header and
+    several ranges are sent as ``multipart/byteranges``. If ``range`` is
+    None, the whole file is sent (200).
+
+    If the server supports the ASGI zero-copy send extension, the file is
+    handed to it to send with ``sendfile``. Otherwise it's read in large
+    chunks with ``pread`` in the thread pool.
+    '''
+    chunk_size = 1024 * 1024
 
     def __init__(
         self,
         path: PathLike,
-        range: OpenRange,
+        range: t.Union[OpenRange, ClosedRange, t.Sequence[ClosedRange], None],
         headers: t.Optional[t.Dict[str, str]] = None,
         media_type: t.Optional[str] = None,
         filename: t.Optional[str] = None,
@@ -57,6 +107,7 @@ class RangedFileResponse(Response):
         self.path = path
         self.range = range
         self.filename = filename
+        self.background = None
         self.send_header_only = method is not None and method.upper() == "HEAD"
         self.media_type = media_type or guess_type(filename or path)[0] or "text/plain"
         self.init_headers(headers or {})
@@ -69,6 +120,17 @@ class RangedFileResponse(Response):
             ))
         self.stat_result = stat_result
 
+    def get_ranges(self) -> t.List[ClosedRange]:
+        assert self.stat_result
+        size = self.stat_result.st_size
+        if self.range is None:
+            return [ClosedRange(0, size - 1)] if size else []
+        ranges = [self.range] if isinstance(self.range, (OpenRange, ClosedRange)) else self.range
+        return [
+            r.clamp(0, size - 1) if isinstance(r, OpenRange) else r
+            for r in ranges
+        ]
+
     def set_range_headers(self, range: ClosedRange) -> None:
         assert self.stat_result
         total_length = self.stat_result.st_size
@@ -76,6 +138,18 @@ class RangedFileResponse(Response):
         self.headers["content-range"] = f"bytes {range.start}-{range.end}/{total_length}"
         self.headers["content-length"] = str(content_length)
 
+    def get_part_headers(self, ranges: t.List[ClosedRange], boundary: str) -> t.List[bytes]:
+        assert self.stat_result
+        total_length = self.stat_result.st_size
+        return [
+            (
+                f"\r\n--{boundary}\r\n"
+                f"content-type: {self.media_type}\r\n"
+                f"content-range: bytes {r.start}-{r.end}/{total_length}\r\n\r\n"
+            ).encode("latin-1")
+            for r in ranges
+        ]
+
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         if self.stat_result is None:
             try:
@@ -86,30 +160,64 @@ class RangedFileResponse(Response):
                 if not stat.S_ISREG(stat_result.st_mode):
                     raise RuntimeError(f"File at path {self.path} is not a file.")
 
-        byte_range = self.range.clamp(0, self.stat_result.st_size - 1)
-        self.set_range_headers(byte_range)
+        ranges = self.get_ranges()
+        part_headers = None
+        if self.range is None:
+            status_code = 200
+            self.headers["content-length"] = str(self.stat_result.st_size)
+        elif len(ranges) == 1:
+            status_code = 206
+            self.set_range_headers(ranges[0])
+        else:
+            status_code = 206
+            boundary = secrets.token_hex(16)
+            part_headers = self.get_part_headers(ranges, boundary)
+            closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            self.headers["content-length"] = str(
+                sum(map(len, part_headers)) + sum(map(len, ranges)) + len(closing))
+
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": self.raw_headers,
+        })
+        if self.send_header_only or not ranges:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = ZEROCOPY in scope.get("extensions", {})
+        with await run_in_threadpool(open, self.path, "rb") as file:
+            if part_headers is None:
+                await self.send_range(send, file, ranges[0], zerocopy)
+                return
+            for header, r in zip(part_headers, ranges):
+                await send({"type": "http.response.body", "body": header, "more_body": True})
+                await self.send_range(send, file, r, zerocopy, more_body=True)
+            await send({"type": "http.response.body", "body": closing, "more_body": False})
 
-        async with aiofiles.open(self.path, mode="rb") as file:
-            await file.seek(byte_range.start)
+    async def send_range(self, send: Send, file: t.BinaryIO, range: ClosedRange, zerocopy: bool = False, more_body: bool = False) -> None:
+        if zerocopy:
             await send({
-                "type": "http.response.start",
-                "status": 206,
-                "headers": self.raw_headers,
+                "type": ZEROCOPY,
+                "file": file,
+                "offset": range.start,
+                "count": len(range),
+                "more_body": more_body,
+            })
+            return
+
+        offset, end = range.start, range.end + 1
+        while offset < end:
+            chunk = await run_in_threadpool(os.pread, file.fileno(), min(self.chunk_size, end - offset), offset)
+            if not chunk:
+                raise RuntimeError(f"File at path {self.path} was truncated while sending it.")
+            offset += len(chunk)
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": offset < end or more_body,
             })
-            if self.send_header_only or not byte_range:
-                await send({"type": "http.response.body", "body": b"", "more_body": False})
-                return
-
-            remaining_bytes = len(byte_range)
-            while remaining_bytes > 0:
-                chunk_size = min(self.chunk_size, remaining_bytes)
-                chunk = await file.read(chunk_size)
-                remaining_bytes -= len(chunk)
-                await send({
-                    "type": "http.response.body",
-                    "body": chunk,
-                    "more_body": remaining_bytes > 0,
-                })
 
 
 class RangedStaticFiles(StaticFiles):
@@ -133,9 +241,5 @@ class RangedStaticFiles(StaticFiles):
         stat_result: os.stat_result,
         scope: Scope,
     ) -> Response:
-        match = RANGE_REGEX.search(Headers(scope=scope)["range"])
-        if not match:
-            raise HTTPException(400)
-        start, end = match.group("start"), match.group("end")
-        range = OpenRange(int(start), int(end) if end else None)
-        return RangedFileResponse(full_path, range, stat_result=stat_result, method=scope["method"])
+        ranges = parse_range_header(Headers(scope=scope)["range"], stat_result.st_size)
+        return RangedFileResponse(full_path, ranges, stat_result=stat_result, method=scope["method"])
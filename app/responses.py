@@ -0,0 +1,58 @@
+import typing as t
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+class SegmentedResponse(Response):
+    '''A response whose body is a list of buffers (e.g. from ``pack_entries``).
+
+    Each segment is written out as is, so the payloads are never joined
+    into a single body, and the ``Content-Length`` is known up front.
+    '''
+    def __init__(
+        self,
+        segments: t.Sequence[t.Union[bytes, memoryview]],
+        status_code: int = 200,
+        headers: t.Optional[t.Mapping[str, str]] = None,
+        media_type: t.Optional[str] = None,
+        background: t.Optional[BackgroundTask] = None,
+    ) -> None:
+        self.segments = segments
+        self.status_code = status_code
+        self.media_type = self.media_type if media_type is None else media_type
+        self.background = background
+        self.body = b''
+        self.init_headers(headers)
+        self.headers['content-length'] = str(sum(memoryview(x).nbytes for x in segments))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get('method') != 'HEAD':
+            for x in self.segments:
+                if len(x):
+                    await send({"type": "http.response.body", "body": x, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.background is not None:
+            await self.background()
+
+
+class SegmentedStreamingResponse(StreamingResponse):
+    '''A ``StreamingResponse`` that passes buffers (e.g. memoryviews from
+    ``pack_entries``) through as they are instead of requiring bytes.'''
+    async def stream_response(self, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        async for chunk in self.body_iterator:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(self.charset)
+            if len(chunk):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
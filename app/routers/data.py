@@ -1,18 +1,28 @@
 import time
 import asyncio
+import hashlib
+import contextlib
 import io
 import itertools
 import orjson
 import re
-from fastapi import APIRouter, Depends, Query, Path, HTTPException, File, Request, UploadFile, WebSocket, WebSocketDisconnect
+import redis
+import cv2
+from fastapi import APIRouter, Depends, Query, Path, Header, HTTPException, File, Request, Response, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 from websockets.exceptions import ConnectionClosed
 from app.auth import UserAuth
 # from app.store import DataStream
-from app.core.streams import Streams, MultiStreamCursor
-from app.utils import get_tag_names, pack_entries
+from app.core.streams import Streams, MultiStreamCursor, EntryWriter
+from app.core.broadcast import BROADCASTS
+from app.core.flow import CreditWindow
+from app.core.pacing import Pacer
+from app.utils import get_tag_names, pack_entries, pack_entries_bin, unpack_entries_bin, pack_entries_page
+from app.formparsers import iter_multipart
+from app.responses import SegmentedResponse, SegmentedStreamingResponse
 from app import utils
 from app.core import holoframe, converters
+from app.core.conversions import convert_entries, output_options
 
 STREAM_STORE = Streams()
 
@@ -30,9 +40,39 @@ PARAM_LAST_ENTRY_ID = Query('*', description="Start retrieving entries later tha
 PARAM_LAST_ENTRY_ID_BLOCK = Query('$', description="Start retrieving entries later than the provided ID")
 PARAM_COUNT = Query(1, description="the maximum number of entries for each receive")
 PARAM_INPUT = Query(None, description="The entry input format. If not provided, the format will be guessed.")
-PARAM_OUTPUT = Query(None, description="The entry output format. Use this if you want to convert to a different format - e.g. jpg, png, json.")
+PARAM_OUTPUT = Query(None, description="The entry output format. Use this if you want to convert to a different format - e.g. jpg, png, json, depthviz.")
 PARAM_PARSE_META = Query(False, description='Try to parse frame as a hololens format to get the timestamp.')
 PARAM_TIME_SYNC_ID = Query(None, description="the stream ID to synchronize by")
+PARAM_COMPRESSED = Query(False, description="set to 'true' to receive the entries as they are stored (i.e. compressed if the stream has a compression codec) instead of decompressing them. Ignored if an output format is provided.")
+PARAM_PROTO = Query(None, description="set to 'bin' to send each batch as a single binary message (header table + payloads) instead of alternating json offsets and bytes.")
+
+def get_output_options(
+        max_width: int | None = Query(None, ge=1, description="Scale image outputs down to fit within this width (keeping the aspect ratio)."),
+        max_height: int | None = Query(None, ge=1, description="Scale image outputs down to fit within this height (keeping the aspect ratio)."),
+        scale: float | None = Query(None, gt=0, le=1, description="Scale image outputs down by this factor."),
+        quality: int | None = Query(None, ge=1, le=95, description="The jpeg quality of image outputs."),
+        grayscale: bool = Query(False, description="Convert image outputs to grayscale."),
+        near: int | None = Query(None, ge=0, le=65535, description="The closest depth to color for `depthviz` outputs (mm)."),
+        far: int | None = Query(None, ge=1, le=65535, description="The farthest depth to color for `depthviz` outputs (mm)."),
+        colormap: str | None = Query(None, description="The opencv colormap for `depthviz` outputs, e.g. turbo, jet, bone."),
+    ):
+    '''Options for image output formats (e.g. jpg, png, depthviz).'''
+    # check these here - the conversion workers would only fail per frame
+    if colormap is not None and not hasattr(cv2, f'COLORMAP_{colormap.upper()}'):
+        raise HTTPException(status_code=400, detail=f"Unknown colormap: {colormap!r}")
+    if near is not None or far is not None:
+        defaults = converters.DepthViz()
+        n, f = (defaults.near if near is None else near), (defaults.far if far is None else far)
+        if n >= f:
+            raise HTTPException(status_code=400, detail=f"near ({n}) must be less than far ({f})")
+    return output_options(
+        max_width=max_width, max_height=max_height, scale=scale, quality=quality, grayscale=grayscale,
+        near=near, far=far, colormap=colormap)
+
+
+# the maximum number of pushed batches waiting to be written before we stop reading from the socket
+PUSH_MAX_PENDING = 64
+
 
 @router.post('/{stream_id}', summary='Send data to one or multiple streams')
 async def send_data_entries(
@@ -53,12 +93,64 @@ async def send_data_entries(
     return await STREAM_STORE.add_entries(zip(sids, ts, data))
 
 
-@router.get('/{stream_id}', summary='Retrieve data from one or multiple streams', response_class=StreamingResponse)
+@router.post('/{stream_id}/stream', summary='Stream data to one or multiple streams')
+async def stream_data_entries(
+        request: Request, response: Response,
+        sid: str = PARAM_STREAM_ID,
+        parse_meta=PARAM_PARSE_META,
+        chunk_count: int = Query(64, description="the maximum number of entries to write at a time"),
+        chunk_size: int = Query(16*1024*1024, description="the maximum number of bytes to write at a time")):
+    """The same as `POST /data/{stream_id}`, except that entries are
+    written as the multipart body is received, in pipelines of at most
+    **chunk_count** entries / **chunk_size** bytes. Use this for bulk
+    uploads so that the request never has to be held in memory.
+
+    Returns the list of inserted entry IDs. The ingest stats are
+    returned in the `ingest-entries`, `ingest-bytes`, `ingest-seconds`,
+    and `ingest-mb-per-sec` response headers.
+    """
+    t0 = time.time()
+    ids = []
+    nbytes = 0
+    chunk = []
+    chunk_bytes = 0
+
+    async def flush():
+        sids = [p.filename if sid == '*' else sid for p in chunk]
+        data = [p.data for p in chunk]
+        ids.extend(await STREAM_STORE.add_entries(zip(sids, get_ts(data, parse_meta), data)))
+        chunk.clear()
+
+    async for part in iter_multipart(request):
+        if sid == '*' and not part.filename:
+            raise HTTPException(status_code=400, detail="You must set the part filename to the stream ID if using sid='*'")
+        chunk.append(part)
+        chunk_bytes += len(part.data)
+        nbytes += len(part.data)
+        if len(chunk) >= chunk_count or chunk_bytes >= chunk_size:
+            await flush()
+            chunk_bytes = 0
+    if chunk:
+        await flush()
+
+    duration = time.time() - t0
+    response.headers['ingest-entries'] = str(len(ids))
+    response.headers['ingest-bytes'] = str(nbytes)
+    response.headers['ingest-seconds'] = f'{duration:.4f}'
+    response.headers['ingest-mb-per-sec'] = f'{nbytes / (1024.**2) / max(duration, 1e-6):.2f}'
+    return ids
+
+
+@router.get('/{stream_id}', summary='Retrieve data from one or multiple streams', response_class=SegmentedResponse)
 async def get_data_entries(
         sid: str = PARAM_STREAM_ID,
         last_entry_id: str | None = PARAM_LAST_ENTRY_ID,
         count:  int | None = PARAM_COUNT,
         input: str | None=PARAM_INPUT, output: str | None=PARAM_OUTPUT,
+        options: tuple | None = Depends(get_output_options),
+        compressed: bool = PARAM_COMPRESSED,
+        wait: float | None = Query(None, ge=0, le=60, description="When using `If-None-Match` with **last_entry_id**=`*`, wait up to this many seconds for a new entry instead of returning 304 right away."),
+        if_none_match: str | None = Header(None),
     ):
     """This retrieves **count** elements that have later timestamps
     than **last_entry_id** from the specified data stream. The entry
@@ -85,63 +177,249 @@ async def get_data_entries(
     the similar `+` separator (e.g. **last_entry_id**=`$+$`), or for
     the all streams (e.g. just `$`).
 
+    When asking for the latest entries (**last_entry_id**=`*`), the
+    response has an `ETag` header. Send it back as `If-None-Match` to get
+    a `304 Not Modified` (without reading the data) if there's nothing
+    new. Add **wait** to long-poll for a new entry instead.
     """
-    entries = await STREAM_STORE.get_entries(init_last(sid, last_entry_id), count)
+    last = init_last(sid, last_entry_id)
+    variant = (count, input, output, options, compressed)
+    etag = None
+    if all(v == '*' for v in last.values()):
+        sids = list(last)
+        if if_none_match:
+            ids = await STREAM_STORE.get_last_ids(sids, count)
+            if wait and _etag_matches(if_none_match, _make_etag(sids, ids, variant)):
+                ids = await _wait_for_new_ids(sids, ids, count, wait)
+            etag = _make_etag(sids, ids, variant)
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={'etag': etag})
+
+    entries = await STREAM_STORE.get_entries(
+        last, count, decompress=bool(output or not compressed))
+    headers = {}
+    if all(v == '*' for v in last.values()):
+        headers['etag'] = _make_etag(list(last), {
+            (s.decode('utf-8') if isinstance(s, bytes) else s): [ts.decode('utf-8') for ts, _ in reversed(data)]
+            for s, data in entries
+        }, variant)
     if output:
-        entries = convert_entries(entries, output, input)
+        entries = await convert_entries(entries, output, input, options)
     offsets, content = pack_entries(entries)
-    return StreamingResponse(io.BytesIO(content),
-                             headers={'entry-offset': offsets},
+    headers['entry-offset'] = offsets
+    return SegmentedResponse(content,
+                             headers=headers,
                              media_type='application/octet-stream')
 
 
+def _make_etag(sids, ids, variant):
+    '''An ETag for the latest entries of the streams (and how they're formatted).'''
+    key = orjson.dumps([[ids.get(s) or [] for s in sids], repr(variant)])
+    return f'"{hashlib.blake2b(key, digest_size=12).hexdigest()}"'
+
+def _etag_matches(if_none_match, etag):
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+async def _wait_for_new_ids(sids, ids, count, wait):
+    '''Wait for any of the streams to get a new entry (up to ``wait`` seconds).'''
+    with BROADCASTS.subscribe(sids, block=int(wait * 1000), decompress=False) as sub:
+        # check again in case something came in before the reader started
+        new_ids = await STREAM_STORE.get_last_ids(sids, count, max_age=0)
+        if new_ids != ids:
+            return new_ids
+        await sub.next()
+    return await STREAM_STORE.get_last_ids(sids, count, max_age=0)
+
+
+@router.get('/{stream_id}/range', summary='Export all of the data in a time window', response_class=SegmentedStreamingResponse)
+async def get_data_range(
+        sid: str = PARAM_STREAM_ID,
+        start: str = Query('-', description="The first entry ID (or millisecond timestamp) of the window. Use `-` for the start of the stream."),
+        end: str = Query('+', description="The last entry ID (or millisecond timestamp) of the window. Use `+` for the end of the stream."),
+        page_size: int = Query(256, ge=1, le=10000, description="The number of entries to read from each stream at a time."),
+        input: str | None=PARAM_INPUT, output: str | None=PARAM_OUTPUT,
+        options: tuple | None = Depends(get_output_options),
+        compressed: bool = PARAM_COMPRESSED,
+    ):
+    """This retrieves every entry between **start** and **end**
+    (inclusive) from one or multiple streams (separated by `+`), merged
+    in entry ID order.
+
+    The streams are read in pages of **page_size** entries, so the
+    response is streamed (chunked) as it is read. It's a sequence of pages
+    (see `app.utils.pack_entries_page`), each one being:
+
+    `[u4 offsets size][u4 payload size][offsets json][payloads]`
+
+    where the offsets json is the same `[[stream_id,entry_id,offset],...]`
+    as the `entry-offset` header of the regular GET (offsets relative to
+    the page's payloads). Use `app.utils.unpack_entries_pages` to read it.
+    """
+    sids = sid.split('+')
+    pages = STREAM_STORE.iter_range(
+        sids, start, end, page_size, decompress=bool(output or not compressed))
+
+    # read the first page before the response starts, so that bad entry
+    # IDs are a 400 instead of an error in the middle of a 200
+    try:
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except redis.exceptions.ResponseError as e:
+        await pages.aclose()
+        raise HTTPException(status_code=400, detail=f"Invalid entry ID in range {start!r} to {end!r}") from e
+
+    async def iter_segments():
+        async with contextlib.aclosing(pages):
+            entries = first
+            while entries is not None:
+                if output:
+                    entries = await convert_entries(entries, output, input, options)
+                for x in pack_entries_page(entries):
+                    yield x
+                entries = await anext(pages, None)
+
+    return SegmentedStreamingResponse(iter_segments(), media_type='application/octet-stream')
+
+
 @router.websocket('/{stream_id}/push')
 async def push_data_ws(
         ws: WebSocket,
         sid: str = PARAM_STREAM_ID,
         batch:  bool | None = Query(None, description="set to 'true' if entries will be sent in batches (alternate one text, one bytes)"),
         ack: bool | None = Query(False, description="set to 'true' if would like the server to respond to each entry/batch with inserted entry IDs"),
-        parse_meta: bool=PARAM_PARSE_META):
+        parse_meta: bool=PARAM_PARSE_META,
+        proto: str | None = PARAM_PROTO,
+        credit: int | None = Query(None, description="set to use credit-based flow control, granting the client up to this many batches in flight")):
     """
+    With **proto**=`bin`, each batch is a single binary message (see
+    `app.utils.pack_entries_bin`). Entries with an empty stream ID
+    use the stream ID from the url and entries with an empty entry ID
+    are given one by the store.
+
+    With **credit**, the server starts by sending `{"credit": credit}`.
+    Each batch sent uses one credit and the client must not send a batch
+    without one. After each batch is written, the server responds with
+    `{"credit": n}` giving back `n` credits (along with `"ids"` if
+    **ack** is set). Fewer credits are given back when writes or the
+    server are slow, and the window recovers when they are fast again.
+
+    If an entry can't be written (e.g. its entry ID isn't after the
+    stream's last one), the connection is closed with code 1011 and the
+    error as the reason. The other entries, including the rest of that
+    batch, are still written.
     """
     if not (await UserAuth.authorizeWebSocket(ws)):
         return
     await ws.accept()
     
+    binary = proto == 'bin'
     sids = None
     if sid == '*':
-        assert batch
+        assert batch or binary
     elif '+' in sid:
-        assert batch
+        assert batch or binary
         sids = sid.split('+')
     else:
         sids = itertools.repeat(sid)
+    window = None
+    if credit:
+        window = CreditWindow(min(credit, PUSH_MAX_PENDING))
+        await ws.send_text(orjson.dumps({'credit': window.available}).decode('utf-8'))
+    writer = EntryWriter()
+    pending = asyncio.Queue(PUSH_MAX_PENDING)
+    receiver = asyncio.create_task(_receive_batches(
+        ws, writer, pending, window, sids, batch, binary, parse_meta))
+    acks = asyncio.create_task(_send_acks(ws, pending, ack, window))
+    try:
+        # the ack task only stops if a write failed (or the socket closed), so
+        # stop reading right away instead of waiting for the next message
+        await asyncio.wait({receiver, acks}, return_when=asyncio.FIRST_COMPLETED)
+        if acks.done():
+            receiver.cancel()
+            error = acks.exception()
+            if error is not None and not isinstance(error, (WebSocketDisconnect, ConnectionClosed)):
+                print(f"push {sid}: write failed: {error}", flush=True)
+                await ws.close(1011, str(error)[:120])
+        else:
+            receiver.result()  # raise any protocol errors
+    except (WebSocketDisconnect, ConnectionClosed):
+        pass
+    finally:
+        receiver.cancel()
+        await writer.close()
+        acks.cancel()
+        _discard_pending(pending)
+
+
+async def _receive_batches(ws, writer, pending, window, sids, batch=False, binary=False, parse_meta=False):
+    '''Read batches from the socket and queue them to be written.'''
     try:
         while True:
+            if window is not None:
+                await window.wait()
             ts = None
             offsets = [None]
-            if batch:
-                offsets = orjson.loads(await ws.receive_text())
-                if offsets and isinstance(offsets[0], list):
-                    if len(offsets[0]) == 3:
-                        sids, ts, offsets = zip(*offsets)
-                    else:
-                        sids, offsets = zip(*offsets)
-                elif sids is None:
-                    raise ValueError("You must upload the sid with the offsets if using sid='*'")
-            data = await ws.receive_bytes()
-            if not offsets or offsets[0] != 0:
-                offsets = (0,)+tuple(offsets)
-            entries = [data[i:j] for i, j in zip(offsets, offsets[1:])] if batch else [data]
-            ts = ts or get_ts(entries, parse_meta)
-
-            res = await STREAM_STORE.add_entries(zip(sids, ts, entries))
-            if ack:
-                await ws.send_text(','.join(x.decode('utf-8') for x in res))
+            if binary:
+                batch_sids, ts, entries = unpack_entries_bin(await ws.receive_bytes())
+                batch_sids = [s or d for s, d in zip(batch_sids, sids or itertools.repeat(None))]
+                if None in batch_sids:
+                    raise ValueError("You must upload the sid with each entry if using sid='*'")
+                ts = ts if any(ts) else get_ts(entries, parse_meta)
+            else:
+                if batch:
+                    offsets = orjson.loads(await ws.receive_text())
+                    if offsets and isinstance(offsets[0], list):
+                        if len(offsets[0]) == 3:
+                            sids, ts, offsets = zip(*offsets)
+                        else:
+                            sids, offsets = zip(*offsets)
+                    elif sids is None:
+                        raise ValueError("You must upload the sid with the offsets if using sid='*'")
+                data = memoryview(await ws.receive_bytes())
+                if not offsets or offsets[0] != 0:
+                    offsets = (0,)+tuple(offsets)
+                entries = [data[i:j] for i, j in zip(offsets, offsets[1:])] if batch else [data]
+                ts = ts or get_ts(entries, parse_meta)
+                batch_sids = sids
+
+            if window is not None:
+                window.take()
+            # the writer coalesces consecutive batches into a single pipeline
+            await pending.put((writer.add(zip(batch_sids, ts, entries)), time.time()))
     except (WebSocketDisconnect, ConnectionClosed):
-        import traceback
-        traceback.print_exc()
-        print("(WebSocketDisconnect, ConnectionClosed)")
+        pass
+
+
+def _discard_pending(pending):
+    # nobody is going to wait for these anymore
+    while not pending.empty():
+        fut, _ = pending.get_nowait()
+        if fut.done() and not fut.cancelled():
+            fut.exception()
+        else:
+            fut.cancel()
+
+
+async def _send_acks(ws, pending, ack=False, window=None):
+    '''Wait for each batch to be written (in order) and optionally respond
+    with the inserted entry IDs and/or the returned credits.'''
+    try:
+        while True:
+            fut, t0 = await pending.get()
+            res = await fut
+            if window is not None:
+                msg = {'credit': window.complete(time.time() - t0)}
+                if ack:
+                    msg['ids'] = [x.decode('utf-8') if x else None for x in res]
+                await ws.send_text(orjson.dumps(msg).decode('utf-8'))
+            elif ack:
+                await ws.send_text(','.join(x.decode('utf-8') if x else '' for x in res))
+    finally:
+        # nothing will return credits anymore, so don't leave the reader waiting for one
+        if window is not None:
+            window.close()
 
 
 @router.websocket('/{stream_id}/pull')
@@ -154,11 +432,30 @@ async def pull_data_ws(
         latest: bool|None=Query(None, description="should we return all data points or just the latest? This is True unless you provide an absolute timestamp with last_entry_id"),
         timeout: int|None=None,
         onebyone: bool=False,
-        rate_limit: float|None=Query(None, description="Rate limit the output of data (in seconds per iteration)."),
+        rate_limit: float|None=Query(None, description="Rate limit the output of data (in seconds per iteration). If latest is set, stale batches are skipped instead of queued."),
         input: str|None=PARAM_INPUT, output: str|None=PARAM_OUTPUT,
+        options: tuple | None = Depends(get_output_options),
         ack: bool | None = Query(False, description="set to 'true' to wait for the client to send an acknowledgement message (of any content) before sending more data"),
+        shared: bool = Query(True, description="set to 'false' to read using a dedicated cursor instead of the shared reader. A shared reader is only used with **latest** and skips ahead to the latest batch if the client falls behind."),
+        proto: str | None = PARAM_PROTO,
+        compressed: bool = PARAM_COMPRESSED,
+        align: str | None = Query(None, regex='^(id|time)$', description="set to 'id' (redis entry IDs) or 'time' (hololens device time) to pair up the entries of each stream with the nearest entry of the **time_sync_id** stream (or the first stream). The i-th entries of each stream in a batch belong together. Entries without a match are dropped."),
+        align_tolerance: float = Query(50, description="the maximum time difference (in milliseconds) between aligned entries."),
     ):
     """
+    When reading only the latest entries (**last_entry_id**=`$` and
+    **latest**), all connections watching the same streams share a
+    single reader, so each batch is only read from the store once. With
+    **latest**=`false`, every entry is delivered, so a dedicated cursor
+    is used instead.
+
+    With **proto**=`bin`, each batch is sent as a single binary message
+    (see `app.utils.pack_entries_bin`) instead of a json text message
+    followed by a bytes message.
+
+    With **align**, every entry is read (not just the latest) and the
+    streams are paired up by timestamp, so e.g. each `main` frame comes
+    with the `depthlt` frame closest to it.
     """
     if not (await UserAuth.authorizeWebSocket(ws)):
         return
@@ -169,38 +466,55 @@ async def pull_data_ws(
         last = init_last(sid, last_entry_id)
         latest = latest if latest is not None else (last_entry_id is None or '$' in last_entry_id or '-' in last_entry_id)
         print(last, latest, flush=True)
-        cursor = MultiStreamCursor(last, latest=latest, time_sync_id=time_sync_id, block=timeout or 3000)
-        
-        tlast = time.time()
-        while True:
-            entries = await cursor.next()
-            if entries:
-                entries_batch = [[x] for x in entries] if onebyone else [entries]
-                for entries in entries_batch:
+        decompress = bool(output or not compressed)
+        if shared and latest and not align and all(v == '$' for v in last.values()):
+            reader = BROADCASTS.subscribe(
+                list(last), latest=latest, time_sync_id=time_sync_id, block=timeout or 3000, decompress=decompress)
+        else:
+            reader = contextlib.nullcontext(MultiStreamCursor(
+                last, latest=latest, time_sync_id=time_sync_id, block=timeout or 3000, decompress=decompress,
+                align=align, align_tolerance=align_tolerance))
+
+        with reader as cursor:
+            batches = _iter_batches(cursor, onebyone, timeout)
+            if rate_limit:
+                client = f'{ws.client.host}:{ws.client.port}' if ws.client else None
+                batches = Pacer(rate_limit, latest=latest, name=client).pace(batches)
+            async with contextlib.aclosing(batches):
+                async for entries in batches:
                     if output:
-                        entries = convert_entries(entries, output, input)
-                    offsets, content = pack_entries(entries)
-                    await ws.send_text(offsets)
-                    await ws.send_bytes(content)
+                        entries = await convert_entries(entries, output, input, options)
+                    if proto == 'bin':
+                        await ws.send_bytes(pack_entries_bin(entries))
+                    else:
+                        offsets, content = pack_entries(entries)
+                        await ws.send_text(offsets)
+                        # a websocket message has to be a single buffer
+                        await ws.send_bytes(b''.join(content))
                     if ack:
                         await ws.receive()
-                    if rate_limit:
-                        tnow=time.time()
-                        time.sleep(max(0, rate_limit - (tnow - tlast)))
-                        tlast=tnow
-            elif timeout:
-                break
     except (WebSocketDisconnect, ConnectionClosed):
         pass
 
 
+async def _iter_batches(cursor, onebyone=False, timeout=None):
+    '''Read batches from a cursor (or subscription) until it times out.'''
+    while True:
+        entries = await cursor.next()
+        if entries:
+            for batch in ([[x] for x in entries] if onebyone else [entries]):
+                yield batch
+        elif timeout:
+            return
+
+
 
 async def mjpeg_stream(sid, count, last_entry_id, time_sync_id, input):
     last = init_last(sid, last_entry_id)
     while True:
         entries = await STREAM_STORE.get_entries(last, count, block=10000)
         if entries:
-            for sid, data in convert_entries(entries, 'jpg', input):
+            for sid, data in await convert_entries(entries, 'jpg', input):
                 for ts, frame in data:
                     yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
             last = update_last(last, entries, time_sync_id)
@@ -232,15 +546,5 @@ def update_last(last, entries, time_sync_id=None):
 
 def get_ts(entries, parse_meta=False):
     if parse_meta:
-        metas = [holoframe.load(d) for d in entries]
-        ts = [d.get('time') for d in metas]
-    else:
-        ts = [None] * len(entries)
-    return ts
-
-def convert_entries(entries, output_format, input_format=None):
-    converted = []
-    for sid, data in entries:
-        cvt = converters.get_converter(output_format, input_format, sid)
-        converted.append([sid, [[ts, {**d, b'd': cvt(d[b'd'])}] for ts, d in data]])
-    return converted
+        return holoframe.load_times(entries)
+    return [None] * len(entries)
@@ -0,0 +1,109 @@
+import re
+import time
+import contextlib
+from fastapi import APIRouter, Depends, Query, Path, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from app.auth import UserAuth
+from app.core.streams import Streams, _id_key
+from app.core.utils import format_epoch_ts
+from app.core.broadcast import BROADCASTS
+from app.utils import get_tag_names
+
+STREAM_STORE = Streams()
+
+tags = [
+    {
+        'name': 'events',
+        'description': 'Follow streams of small (e.g. json) entries from the browser using Server-Sent Events'
+    }
+]
+router = APIRouter(prefix='/events', tags=get_tag_names(tags),
+                   dependencies=[Depends(UserAuth.require_authorization)])
+
+# the number of batches a subscriber can fall behind before the stream is
+# closed (the browser then reconnects and catches up from Last-Event-ID)
+EVENTS_MAX_PENDING = 1024
+# the number of entries per stream read at a time
+EVENTS_COUNT = 64
+ENTRY_ID_REGEX = re.compile(r'^\d+(-\d+)?$')
+
+
+@router.get('/{stream_id}', summary='Follow one or multiple streams as Server-Sent Events', response_class=StreamingResponse)
+async def stream_events(
+        sid: str = Path(None, alias='stream_id', description='The stream IDs, separated by `+`'),
+        last_event_id: str | None = Header(None),
+        last_entry_id: str | None = Query(None, description="Start after these entry IDs (same as the `Last-Event-ID` header)."),
+        keepalive: float = Query(15, gt=0, description="Send a comment every this many seconds if there's nothing new."),
+    ):
+    """Each entry is sent as an event named after its stream, with the
+    entry data (e.g. json) as its data. For example, to follow recipe
+    steps from the browser:
+
+    ```
+    const events = new EventSource(`${API_URL}/events/event:recipe:step`);
+    events.addEventListener('event:recipe:step', e => console.log(JSON.parse(e.data)));
+    ```
+
+    The event ID is the latest entry ID of each stream (separated by
+    `+`), so when the browser reconnects, it resumes where it left off
+    using `Last-Event-ID`. All of the subscribers of the same streams
+    share a single reader. If a client falls too far behind, the stream
+    is closed so that it reconnects and catches up from there instead of
+    missing events.
+    """
+    sids = sid.split('+')
+    resume = last_event_id or last_entry_id
+    last = dict(zip(sids, resume.split('+'))) if resume else {}
+    last = {k: v for k, v in last.items() if v not in ('', '$')}
+    invalid = [v for v in last.values() if not ENTRY_ID_REGEX.match(v)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid entry ID: {invalid[0]!r}")
+    return StreamingResponse(
+        _iter_events(sids, last, keepalive),
+        media_type='text/event-stream',
+        headers={'cache-control': 'no-cache', 'x-accel-buffering': 'no'})
+
+
+async def _iter_events(sids, last, keepalive):
+    yield 'retry: 3000\n\n'
+    # streams without a position start from now
+    now = format_epoch_ts(time.time())
+    last = {s: last.get(s) or now for s in sids}
+    # subscribe first so nothing is missed between the catch up and the live entries
+    with BROADCASTS.subscribe(sids, latest=False, maxsize=EVENTS_MAX_PENDING, block=int(keepalive * 1000), count=EVENTS_COUNT) as sub:
+        # catch up on anything after the last event the client saw
+        pages = STREAM_STORE.iter_range(sids, {s: f'({t}' for s, t in last.items()}, '+', EVENTS_COUNT)
+        async with contextlib.aclosing(pages):
+            async for entries in pages:
+                for event in _format_events(sids, last, entries):
+                    yield event
+
+        while True:
+            entries = await sub.next()
+            if sub.dropped:
+                # batches were skipped - end the stream so the browser
+                # reconnects and catches up from the last event it got
+                return
+            if not entries:
+                yield ': keepalive\n\n'
+                continue
+            for event in _format_events(sids, last, entries):
+                yield event
+
+
+def _format_events(sids, last, entries):
+    for sid, data in entries:
+        sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
+        for ts, d in data:
+            ts = ts.decode('utf-8') if isinstance(ts, bytes) else ts
+            if _id_key(ts) <= _id_key(last[sid]):
+                continue  # already sent while catching up
+            last[sid] = ts
+            lines = bytes(d[b'd']).decode('utf-8', 'replace').splitlines() or ['']
+            yield ''.join([
+                f'id: {"+".join(last[s] for s in sids)}\n',
+                f'event: {sid}\n',
+                *(f'data: {line}\n' for line in lines),
+                '\n',
+            ])
+
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import contextlib
 import io
 import itertools
 import orjson
@@ -14,6 +15,9 @@ from app.core.streams import Streams
 from app.utils import get_tag_names, pack_entries
 from app import utils
 from app.core import holoframe, converters
+from app.core.conversions import convert_entries
+from app.core.mjpeg import MJPEG, BOUNDARY, LAYOUTS, to_frame
+from app.routers.data import get_output_options
 
 STREAM_STORE = Streams()
 
@@ -31,28 +35,53 @@ PARAM_STREAM_ID = Path(None, alias='stream_id', description='The unique ID of th
 PARAM_LAST_ENTRY_ID = Query('$', description="Start retrieving entries later than the provided ID")
 PARAM_COUNT = Query(1, description="the maximum number of entries for each receive")
 PARAM_INPUT = Query(None, description="The entry input format. If not provided, the format will be guessed.")
-PARAM_OUTPUT = Query(None, description="The entry output format. Use this if you want to convert to a different format - e.g. jpg, png, json.")
+PARAM_OUTPUT = Query(None, description="The entry output format. Use this if you want to convert to a different format - e.g. jpg, png, json, depthviz.")
 PARAM_PARSE_META = Query(False, description='Try to parse frame as a hololens format to get the timestamp.')
 PARAM_TIME_SYNC_ID = Query(None, description="the stream ID to synchronize by")
 
 
 @router.get('/{stream_id}', summary='Retrieve data from one or multiple streams', response_class=StreamingResponse)
 async def stream_jpeg_frames(
+        request: Request,
         sid: str = PARAM_STREAM_ID,
         count:  int | None = PARAM_COUNT,
         last_entry_id: str | None = PARAM_LAST_ENTRY_ID,
         time_sync_id:  str | None = PARAM_TIME_SYNC_ID,
-        input: str|None=PARAM_INPUT
+        input: str|None=PARAM_INPUT,
+        output: str = Query('jpg', description="The image format to send the frames as - e.g. jpg, or depthviz for depth streams."),
+        options: tuple | None = Depends(get_output_options),
+        fps: float | None = Query(None, gt=0, le=60, description="The maximum frame rate to send. Frames are also skipped if the connection can't keep up."),
+        layout: str | None = Query(None, description=f"Tile the streams into a single image: {', '.join(LAYOUTS)}."),
+        tile_width: int = Query(320, gt=0, le=1920, description="The width of each tile in a layout."),
+        tile_height: int = Query(240, gt=0, le=1080, description="The height of each tile in a layout."),
     ):
     """mjpeg video stream to an image tag.
 
     ```
     <img src={`${API_URL}/data/mjpeg/main`} />
     ```
+
+    When following the latest frames of a single stream, all viewers
+    share the same frames, and jpeg frames from the hololens are sent
+    without re-encoding them (unless output options are given). Each
+    viewer always gets the newest frame - frames that come in while the
+    previous one is still being sent are skipped.
+
+    With `layout`, the latest frame of each stream is tiled into one
+    image (e.g. `/mjpeg/main+gll+glf+depthlt?layout=grid`), which is
+    encoded once per tick and shared by all viewers of that layout.
     """
-    return StreamingResponse(
-        mjpeg_stream(sid, count, last_entry_id, time_sync_id, input), 
-        media_type="multipart/x-mixed-replace;boundary=frame")
+    if layout:
+        if layout not in LAYOUTS:
+            raise HTTPException(status_code=400, detail=f"Unknown layout {layout!r}. Use one of: {', '.join(LAYOUTS)}")
+        client = f'{request.client.host}:{request.client.port}' if request.client else None
+        stream = mosaic_stream(sid.split('+'), layout, input, options, (tile_width, tile_height), client, fps)
+    elif '+' not in sid and last_entry_id == '$':
+        client = f'{request.client.host}:{request.client.port}' if request.client else None
+        stream = shared_mjpeg_stream(sid, input, options, client, fps, output)
+    else:
+        stream = mjpeg_stream(sid, count, last_entry_id, time_sync_id, input, options, output)
+    return StreamingResponse(stream, media_type=f"multipart/x-mixed-replace;boundary={BOUNDARY}")
     
 
 placeholder_fname = 'please-stand-by.jpg'
@@ -62,8 +91,26 @@ with open(os.path.join(os.path.dirname(__file__), placeholder_fname), 'rb') as f
 black_frame = converters.registry['jpg']().dump(np.zeros((428, 760, 3), dtype=np.uint8))
 
 
+async def shared_mjpeg_stream(sid, input, options=None, client=None, fps=None, output='jpg'):
+    yield to_frame(black_frame)
+    with MJPEG.subscribe(sid, input, options, output, name=client, fps=fps) as viewer:
+        frames = viewer.frames()
+        async with contextlib.aclosing(frames):
+            async for frame in frames:
+                yield frame if frame is not None else to_frame(placeholder_frame)
+
 
-async def mjpeg_stream(sid, count, last_entry_id, time_sync_id, input):
+async def mosaic_stream(sids, layout, input, options=None, tile_size=(320, 240), client=None, fps=None):
+    yield to_frame(black_frame)
+    with MJPEG.subscribe_mosaic(sids, layout, input, options, tile_size, name=client, fps=fps) as viewer:
+        frames = viewer.frames()
+        async with contextlib.aclosing(frames):
+            async for frame in frames:
+                if frame is not None:
+                    yield frame
+
+
+async def mjpeg_stream(sid, count, last_entry_id, time_sync_id, input, options=None, output='jpg'):
     yield _toframe(black_frame)
 
     last = init_last(sid, last_entry_id)
@@ -73,14 +120,14 @@ async def mjpeg_stream(sid, count, last_entry_id, time_sync_id, input):
             yield _toframe(placeholder_frame)
             continue
 
-        for sid, data in convert_entries(entries, 'jpg', input):
+        for sid, data in await convert_entries(entries, output, input, options):
             for ts, frame in data:
                 yield _toframe(frame[b'd'])
         last = update_last(last, entries, time_sync_id)
 
 
 def _toframe(frame, ct='image/jpeg'):
-    return b'--frame\r\nContent-Type: {ct}\r\n\r\n' + frame + b'\r\n'
+    return to_frame(frame, ct)
 
 
 def init_last(sid, last_entry_id):
@@ -105,49 +152,36 @@ def update_last(last, entries, time_sync_id=None):
 
 def get_ts(entries, parse_meta=False):
     if parse_meta:
-        metas = [holoframe.load(d) for d in entries]
-        ts = [d.get('time') for d in metas]
-    else:
-        ts = [None] * len(entries)
-    return ts
+        return holoframe.load_times(entries)
+    return [None] * len(entries)
 
-def convert_entries(entries, output_format, input_format=None):
-    converted = []
-    for sid, data in entries:
-        cvt = converters.get_converter(output_format, input_format, sid)
-        converted.append([sid, [[ts, {**d, b'd': cvt(d[b'd'])}] for ts, d in data]])
-    return converted
 
 
 
+import stat
 import mimetypes
+from aiofiles.os import stat as aio_stat
 from app.core.recordings import RECORDING_POST_PATH
+from app.range_static import RangedFileResponse, parse_range_header
 
 
 CHUNK_SIZE = 1024*1024
 
 @router.get("/chunked/{file_path:path}", summary='stream recording video')
 async def video_endpoint(file_path: str, range: str = Header(None)):
+    """Get byte ranges of a recording's video, e.g. for a video player
+    that's seeking. Open ended ranges (`bytes=1000-`) get up to 1MB and
+    multiple ranges are sent as `multipart/byteranges`."""
     file_path = os.path.join(RECORDING_POST_PATH, file_path)
-    start, end = range.replace("bytes=", "").split("-")
-    start = int(start)
-    end = int(end) if end else start + CHUNK_SIZE
-    total = os.stat(file_path).st_size
-    print(start, end, total, 1.*(end-start)/total, flush=True)
-    with open(file_path, "rb") as f:
-        f.seek(start)
-        data = f.read(end - start)
-        print(len(data), flush=True)
-
-        return Response(
-            data,
-            status_code=206,
-            headers={
-                'Content-Range': f'bytes {start}-{end}/{total}',
-                'Accept-Ranges': 'bytes'
-            },
-            media_type=mimetypes.guess_type(file_path)[0] or "video/mp4")
-
-
-
-
+    try:
+        stat_result = await aio_stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="Video not found")
+    ranges = parse_range_header(range, stat_result.st_size, max_length=CHUNK_SIZE) if range else None
+    return RangedFileResponse(
+        file_path, ranges,
+        stat_result=stat_result,
+        headers={'accept-ranges': 'bytes'},
+        media_type=mimetypes.guess_type(file_path)[0] or "video/mp4")
@@ -65,8 +65,31 @@ async def update_stream(
     *override* to silently update the stream parameters without
     returning an error. By default, `max_len` is set to the parameter
     in the `config.json` file, but can be overriden here.
+
+    The stream's retention can be set using these metadata keys
+    (applied as entries are added, `0` means no limit):
+
+    - **max_len**: the maximum number of entries
+    - **max_age**: the maximum age of entries (in seconds)
+    - **max_bytes**: the (approximate) maximum size of the stream (in bytes)
+
+    Entries can also be dropped as they are added (decimation). The
+    number of dropped entries is reported in `/metrics`.
+
+    - **keep_every**: only keep every Nth entry
+    - **max_rate**: keep at most this many entries per second
+
+    Other settings:
+
+    - **compression**: compress entries using `zstd`, `lz4`, or `zlib`
+    - **blob_min_size**: store payloads of at least this many bytes on
+      the server's disk instead of in the stream (defaults to
+      `blob_min_size` in `config.json`, `0` to disable)
     """
-    await STREAM_STORE.set_stream_meta(sid, _update=not override, **meta)
+    try:
+        await STREAM_STORE.set_stream_meta(sid, _update=not override, **meta)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return await STREAM_STORE.get_stream_meta(sid)
 
 @router.delete('/{stream_id}', summary='Delete a stream')
@@ -1,7 +1,10 @@
 from typing import Optional
 import datetime
+import struct
 import orjson
+import numpy as np
 import pydantic
+from app.core.blobs import resolve_entries
 
 
 # def prints_traceback(func):
@@ -33,15 +36,107 @@ def get_tag_names(tags):
     return [x['name'] for x in tags]
 
 def pack_entries(entries):
+    '''Get the entry offsets (as json) and the list of payloads to send back to
+    back. The payloads are memoryviews of the entry data so nothing is copied
+    until (or unless) they're written out.'''
+    entries = resolve_entries(entries)
     offsets = []
-    content = bytearray()
+    segments = []
+    size = 0
     for sid, data in entries:
         sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
         for ts, d in data:
-            offsets.append((sid, ts.decode('utf-8'), len(content)))
-            content += d[b'd']
+            offsets.append((sid, ts.decode('utf-8'), size))
+            segments.append(memoryview(d[b'd']))
+            size += segments[-1].nbytes
     jsonOffsets = orjson.dumps(offsets).decode('utf-8')
-    return jsonOffsets, content
+    return jsonOffsets, segments
+
+
+# Paged framing (used to stream an unknown number of batches in a single
+# response). Each page is:
+#
+#   [u4 offsets size][u4 payload size][offsets json][payload 0][payload 1]...
+#
+# where the offsets json is the same ``[[sid, entry_id, offset], ...]`` as
+# returned by ``pack_entries`` (offsets relative to the page's payload section).
+page_header = struct.Struct('<II')
+
+def pack_entries_page(entries):
+    '''Pack a batch as a page - a list of segments to be written back to back.'''
+    offsets, segments = pack_entries(entries)
+    offsets = offsets.encode('utf-8')
+    return [page_header.pack(len(offsets), sum(x.nbytes for x in segments)), offsets, *segments]
+
+def unpack_entries_pages(data):
+    '''Iterate over the (offsets, payload) of each page in a paged response body.
+    Payloads are memoryviews of ``data``.'''
+    data = memoryview(data)
+    i = 0
+    while i < len(data):
+        noff, size = page_header.unpack_from(data, i)
+        i += page_header.size
+        offsets = orjson.loads(data[i:i + noff])
+        i += noff
+        yield offsets, data[i:i + size]
+        i += size
+
+
+# Binary batch framing (proto=bin). A batch is sent as a single message:
+#
+#   [prelude][n x entry header][payload 0][payload 1]...
+#
+# The stream and entry ID columns are fixed-width (null-padded) for each batch
+# so the header table can be read with a single np.frombuffer on the client:
+#
+#   n, sid_size, id_size = np.frombuffer(msg, bin_prelude_dtype, 1)[0]
+#   table = np.frombuffer(msg, bin_entry_dtype(sid_size, id_size), n, bin_prelude_dtype.itemsize)
+#   start = bin_prelude_dtype.itemsize + table.nbytes
+#
+# entry offsets are relative to the start of the payload section.
+bin_prelude_dtype = np.dtype([
+    ('n', '<u4'),
+    ('sid_size', '<u2'),
+    ('id_size', '<u2'),
+])
+
+def bin_entry_dtype(sid_size, id_size):
+    return np.dtype([
+        ('sid', f'S{max(int(sid_size), 1)}'),
+        ('id', f'S{max(int(id_size), 1)}'),
+        ('offset', '<u4'),
+    ])
+
+def pack_entries_bin(entries):
+    entries = resolve_entries(entries)
+    sids, ids, content = [], [], []
+    for sid, data in entries:
+        sid = sid.encode('utf-8') if isinstance(sid, str) else sid
+        for ts, d in data:
+            sids.append(sid)
+            ids.append(ts.encode('utf-8') if isinstance(ts, str) else ts)
+            content.append(d[b'd'])
+
+    table = np.zeros(len(content), bin_entry_dtype(
+        max(map(len, sids), default=1), max(map(len, ids), default=1)))
+    table['sid'] = sids
+    table['id'] = ids
+    if len(content) > 1:
+        table['offset'][1:] = np.cumsum([len(d) for d in content[:-1]])
+    prelude = np.array([(len(content), table.dtype['sid'].itemsize, table.dtype['id'].itemsize)], dtype=bin_prelude_dtype)
+    return b''.join([prelude.tobytes(), table.tobytes(), *content])
+
+def unpack_entries_bin(data):
+    '''Split a binary batch into (stream IDs, entry IDs, payloads). Empty
+    stream/entry IDs are returned as None. Payloads are memoryviews of ``data``.'''
+    data = memoryview(data)
+    n, sid_size, id_size = np.frombuffer(data, bin_prelude_dtype, 1)[0]
+    table = np.frombuffer(data, bin_entry_dtype(sid_size, id_size), n, bin_prelude_dtype.itemsize)
+    start = bin_prelude_dtype.itemsize + table.nbytes
+    offsets = (table['offset'].astype(int) + start).tolist() + [len(data)]
+    sids = [x.decode('utf-8') or None for x in table['sid'].tolist()]
+    ids = [x.decode('utf-8') or None for x in table['id'].tolist()]
+    return sids, ids, [data[i:j] for i, j in zip(offsets, offsets[1:])]
 
 
 
@@ -0,0 +1,59 @@
+'''Compare the compression codecs on hololens frames.
+
+Use frames dumped by ``python tests/stream.py dump`` (dumps/{stream}/*.bin):
+
+    PYTHONPATH=. python tests/bench_compression.py run dumps
+
+or, without a path, synthetic frames for each frame type.
+'''
+import os
+import glob
+import time
+import numpy as np
+from app.core import compression
+
+
+def synthetic_frames(n=10, seed=0):
+    rng = np.random.default_rng(seed)
+    def smooth(shape, scale, dtype):
+        base = np.sin(np.mgrid[:shape[0], :shape[1]][1] / 40) * scale / 4 + scale / 2
+        return (base + rng.normal(0, scale / 50, shape)).clip(0, scale).astype(dtype)
+    return {
+        # v1 PV frames are raw NV12 (1.5 bytes per pixel)
+        'main': [smooth((428 * 3 // 2, 768), 255, np.uint8).tobytes() for _ in range(n)],
+        'depthlt': [smooth((288, 320), 4000, np.uint16).tobytes() for _ in range(n)],
+        'imuaccel': [rng.normal(0, 1, (93, 3)).astype(np.float32).tobytes() for _ in range(n)],
+    }
+
+
+def load_frames(path, n=10):
+    return {
+        os.path.basename(d): [open(f, 'rb').read() for f in sorted(glob.glob(os.path.join(d, '*.bin')))[:n]]
+        for d in sorted(glob.glob(os.path.join(path, '*')))
+        if os.path.isdir(d)
+    }
+
+
+def run(path=None, n=10, codecs=None):
+    frames = load_frames(path, n) if path else synthetic_frames(n)
+    codecs = codecs.split(',') if isinstance(codecs, str) else codecs or compression.available_codecs()
+    print(f'{"stream":>12} {"codec":>6} {"size (KB)":>10} {"ratio":>6} {"compress (ms)":>14} {"decompress (ms)":>16}')
+    for sid, data in frames.items():
+        if not data:
+            continue
+        size = np.mean([len(d) for d in data])
+        for codec in codecs:
+            t0 = time.perf_counter()
+            compressed = [compression.compress(d, codec) for d in data]
+            t1 = time.perf_counter()
+            for d in compressed:
+                compression.decompress(d, codec)
+            t2 = time.perf_counter()
+            ratio = size / np.mean([len(d) for d in compressed])
+            print(f'{sid:>12} {codec:>6} {size / 1024:>10.1f} {ratio:>6.2f} '
+                  f'{(t1 - t0) / len(data) * 1000:>14.2f} {(t2 - t1) / len(data) * 1000:>16.2f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
@@ -0,0 +1,55 @@
+'''Compare ways of colormapping depth frames (uint16, mm) for display.
+
+    PYTHONPATH=. python tests/bench_depthviz.py run --n=100
+
+``lut`` is the ``depthviz`` converter's lookup table (one ``take`` per
+frame). ``cv2`` clips and scales the frame to uint8 and then applies the
+opencv colormap (which works per pixel). Encoding is left out since it's the
+same for both.
+'''
+import time
+import numpy as np
+import cv2
+from app.core.converters import depth_lut
+
+
+def synthetic_frames(n=10, shape=(288, 320), seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.mgrid[:shape[0], :shape[1]][1]
+    frames = []
+    for i in range(n):
+        d = np.sin((x + i) / 40) * 1500 + 2000 + rng.normal(0, 20, shape)
+        d[rng.random(shape) < 0.05] = 0  # missing readings
+        frames.append(d.clip(0, 65535).astype(np.uint16))
+    return frames
+
+
+def colormap_lut(im, near, far, colormap):
+    return depth_lut(near, far, colormap).take(im, axis=0)
+
+
+def colormap_cv2(im, near, far, colormap):
+    levels = cv2.convertScaleAbs(np.clip(im, near, far) - near, alpha=255 / (far - near))
+    out = cv2.applyColorMap(levels, getattr(cv2, f'COLORMAP_{colormap.upper()}'))
+    out[im == 0] = 0
+    return cv2.cvtColor(out, cv2.COLOR_BGR2RGB)
+
+
+def run(n=100, width=320, height=288, near=0, far=4000, colormap='turbo'):
+    frames = synthetic_frames(n, (height, width))
+    depth_lut(near, far, colormap)  # build the table up front
+    print(f'{n} frames of {width}x{height}')
+    print(f'{"":>6} {"ms/frame":>9} {"fps":>8}')
+    results = {}
+    for name, func in [('lut', colormap_lut), ('cv2', colormap_cv2)]:
+        t0 = time.perf_counter()
+        results[name] = [func(im, near, far, colormap) for im in frames]
+        duration = (time.perf_counter() - t0) / n
+        print(f'{name:>6} {duration * 1000:>9.3f} {1 / duration:>8.0f}')
+    diff = max(np.abs(a.astype(int) - b).max() for a, b in zip(results['lut'], results['cv2']))
+    print(f'max difference: {diff}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
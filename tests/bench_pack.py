@@ -0,0 +1,77 @@
+'''Measure the memory copied when packing a batch of entries for a response.
+
+    PYTHONPATH=. python tests/bench_pack.py run --n=8 --size=2000000
+
+``before`` reproduces the old path (append every payload into a bytearray,
+then stream it from a BytesIO) and ``after`` is ``pack_entries`` with the
+segments written out directly by ``SegmentedResponse``.
+'''
+import io
+import time
+import asyncio
+import tracemalloc
+import orjson
+from app.utils import pack_entries
+from app.responses import SegmentedResponse
+
+
+def make_entries(n=8, size=2_000_000, streams=('main', 'depthlt')):
+    return [
+        (sid.encode(), [(f'{i}-0'.encode(), {b'd': bytes(size)}) for i in range(n)])
+        for sid in streams
+    ]
+
+
+def pack_entries_before(entries):
+    offsets = []
+    content = bytearray()
+    for sid, data in entries:
+        sid = sid.decode('utf-8') if isinstance(sid, bytes) else sid
+        for ts, d in data:
+            offsets.append((sid, ts.decode('utf-8'), len(content)))
+            content += d[b'd']
+    return orjson.dumps(offsets).decode('utf-8'), content
+
+
+async def send_before(entries, send):
+    offsets, content = pack_entries_before(entries)
+    body = io.BytesIO(content)
+    while chunk := body.read(64 * 1024):
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+
+async def send_after(entries, send):
+    offsets, content = pack_entries(entries)
+    response = SegmentedResponse(content, headers={'entry-offset': offsets})
+    await response({'type': 'http', 'method': 'GET'}, None, send)
+
+
+async def measure(func, entries, repeat):
+    sent = 0
+    async def send(msg):
+        nonlocal sent
+        sent += len(msg.get('body') or b'')
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        await func(entries, send)
+    duration = (time.perf_counter() - t0) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak, sent // repeat
+
+
+def run(n=8, size=2_000_000, repeat=10):
+    entries = make_entries(n, size)
+    total = sum(len(d[b'd']) for _, data in entries for _, d in data)
+    print(f'{n * 2} entries, {total / 1024**2:.1f} MB per request')
+    print(f'{"":>8} {"ms/request":>11} {"peak copied (MB)":>17} {"sent (MB)":>10}')
+    for name, func in [('before', send_before), ('after', send_after)]:
+        duration, peak, sent = asyncio.run(measure(func, entries, repeat))
+        print(f'{name:>8} {duration * 1000:>11.2f} {peak / 1024**2:>17.1f} {sent / 1024**2:>10.1f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
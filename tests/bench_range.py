@@ -0,0 +1,66 @@
+'''Measure serving byte ranges of a file to many concurrent clients.
+
+    PYTHONPATH=. python tests/bench_range.py run --clients=32 --size=1000000
+
+``before`` reproduces the old ``RangedFileResponse`` loop (4KB ``aiofiles``
+reads) and ``after`` is the current one (1MB ``pread`` chunks, or
+``sendfile`` on servers with the zero-copy extension - which needs a real
+socket, so it isn't measured here). Throughput per core is the bytes sent
+divided by the CPU time used by the process (including the thread pool).
+'''
+import os
+import time
+import random
+import asyncio
+import tempfile
+import aiofiles
+from app.range_static import RangedFileResponse, ClosedRange
+
+
+async def send_before(path, r, send):
+    async with aiofiles.open(path, mode="rb") as file:
+        await file.seek(r.start)
+        remaining = len(r)
+        while remaining > 0:
+            chunk = await file.read(min(4096, remaining))
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+
+async def send_after(path, r, send):
+    response = RangedFileResponse(path, r)
+    await response({"type": "http", "method": "GET"}, None, send)
+
+
+async def measure(func, path, total, clients, requests, size):
+    sent = 0
+    async def send(msg):
+        nonlocal sent
+        sent += len(msg.get("body") or b"")
+
+    async def client(seed):
+        rng = random.Random(seed)
+        for _ in range(requests):
+            start = rng.randrange(0, total - size)
+            await func(path, ClosedRange(start, start + size - 1), send)
+
+    t0, c0 = time.perf_counter(), time.process_time()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    return time.perf_counter() - t0, time.process_time() - c0, sent
+
+
+def run(clients=32, requests=8, size=1_000_000, file_size=200_000_000):
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(file_size))
+        f.flush()
+        print(f'{clients} clients x {requests} requests of {size / 1024**2:.1f} MB')
+        print(f'{"":>8} {"wall (s)":>9} {"cpu (s)":>8} {"MB/s":>8} {"MB/s/core":>10}')
+        for name, func in [('before', send_before), ('after', send_after)]:
+            wall, cpu, sent = asyncio.run(measure(func, f.name, file_size, clients, requests, size))
+            mb = sent / 1024**2
+            print(f'{name:>8} {wall:>9.2f} {cpu:>8.2f} {mb / wall:>8.0f} {mb / max(cpu, 1e-9):>10.0f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()